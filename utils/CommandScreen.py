@@ -1,16 +1,20 @@
 #!/usr/bin/env python
 import curses
 from threading import Thread, Lock
+import tempfile
+import shutil
 import sys
-from time import sleep
-from collections import deque
+import os
+from time import sleep, time
+
+from Scrollback import Scrollback
 
 class CommandScreen(Thread):
 
     topbar_attr = curses.A_BOLD | curses.A_UNDERLINE
     menu_attr = curses.A_NORMAL
 
-    def __init__(self):
+    def __init__(self, fps=20, scrollback_dir=None):
         Thread.__init__(self)
         self.__stop=False
         self.daemon=True
@@ -22,9 +26,28 @@ class CommandScreen(Thread):
         self.__selected=0
         self.__lmenu_xoffset=0
 
+        #the full output of every tab is kept on disk, in a temporary directory unless specified otherwise
+        self.__scrollback_tmp=scrollback_dir is None
+        self.__scrollback_dir=scrollback_dir or tempfile.mkdtemp(prefix='commandscreen')
+        if not os.path.isdir(self.__scrollback_dir):
+            os.makedirs(self.__scrollback_dir)
         self.__text_buffers=[]
+
+        #the view of every tab: the index of the bottom line on the screen and the number of its wrapped rows hidden below the screen
+        #a bottom line of None follows the end of the output
         self.__term_scroll=[]
-        self.__line_buffer_size=1024
+
+        #incremental search, the pattern is None while not searching
+        self.__search=None
+        self.__search_pattern=''
+        self.__search_start=None
+
+        #producers only append text and mark their tab dirty, the loop redraws the selected tab at most fps times per second
+        self.__frame_interval=1.0/fps
+        self.__dirty=set()
+
+        #lines currently shown in the terminal window, only rows that change are redrawn
+        self.__shown=[]
 
         self.focus='lmenu'
 
@@ -40,36 +63,121 @@ class CommandScreen(Thread):
         with self.l:
             self.__lmenu_items+=[name]
             self.reset_screen=True
-            self.__text_buffers+=[(Lock(), deque(maxlen=self.__line_buffer_size))]
-            self.__term_scroll+=[0]
+            fname=os.path.join(self.__scrollback_dir, '%d_%s.log'%(len(self.__lmenu_items)-1, name.replace('/', '_')))
+            self.__text_buffers+=[Scrollback(fname)]
+            self.__term_scroll+=[(None, 0)]
             #return handle
             return len(self.__lmenu_items)-1
 
     def print_text(self, handle, text):
-        lock, buf = self.__text_buffers[handle]
-
-        #cut new text in lines of width that match the current terminal
-        width=self.term_width
-
-        #first get lock on this text buffer
-        with lock:
-            cnt=0
-            for line in text.split('\n'):
-                for subline_start in range(0,len(line), width):
-                    subline_end = min(subline_start+width, len(line))
-                    subline = line[subline_start:subline_end]
-
-                    #add sublines to the buffer
-                    buf.append(subline)
-                    cnt+=1
-
-            #adjust scroll offset
-            if self.__term_scroll[handle]!=0:
-                self.__term_scroll[handle]+=cnt
-
-        #ask for a screen update
-        if handle == self.__selected:
-            self.__draw_term()
+        #lines are wrapped when they are drawn, so the view of a scrolled tab does not move when text is added
+        self.__text_buffers[handle].append(text)
+
+        #ask for a screen update with the next frame
+        self.__dirty.add(handle)
+
+    def __wrap(self, line):
+        #rows of a line at the current terminal width
+        width=max(1, self.term_width-1)
+        return [ line[start:start+width] for start in range(0, max(1, len(line)), width) ]
+
+    def __view(self):
+        #bottom line and hidden rows of the selected tab, with the end of the output resolved
+        buf=self.__text_buffers[self.__selected]
+        bottom, hidden = self.__term_scroll[self.__selected]
+        if bottom is None:
+            return len(buf)-1, 0
+        return bottom, hidden
+
+    def __rows(self, bottom, hidden):
+        #the rows that fit on the screen, ending with the given view, top row first
+        buf=self.__text_buffers[self.__selected]
+        rows=[]
+        idx=bottom
+        while idx>=0 and len(rows)<self.term_height:
+            wrapped=self.__wrap(buf.line(idx))
+            if idx==bottom:
+                wrapped=wrapped[0:len(wrapped)-hidden]
+            rows=wrapped+rows
+            idx-=1
+        return rows[-self.term_height:]
+
+    def __scroll_up(self, cnt):
+        #every step only visits the rows it scrolls over, no matter how long the output is
+        bottom, hidden = self.__view()
+        buf=self.__text_buffers[self.__selected]
+        while cnt>0 and bottom>=0:
+            rows=len(self.__wrap(buf.line(bottom)))
+            if hidden<rows-1:
+                step=min(rows-1-hidden, cnt)
+                hidden+=step
+                cnt-=step
+            elif bottom>0:
+                bottom-=1
+                hidden=0
+                cnt-=1
+            else:
+                break
+
+        #do not scroll beyond the first line
+        if len(self.__rows(bottom, hidden))<self.term_height:
+            self.__scroll_home()
+        else:
+            self.__term_scroll[self.__selected]=(bottom, hidden)
+
+    def __scroll_down(self, cnt):
+        bottom, hidden = self.__view()
+        buf=self.__text_buffers[self.__selected]
+        while cnt>0:
+            if hidden>0:
+                step=min(hidden, cnt)
+                hidden-=step
+                cnt-=step
+            elif bottom<len(buf)-1:
+                bottom+=1
+                hidden=len(self.__wrap(buf.line(bottom)))-1
+                cnt-=1
+            else:
+                break
+
+        #back at the end, follow the output again
+        if bottom>=len(buf)-1 and hidden==0:
+            bottom=None
+        self.__term_scroll[self.__selected]=(bottom, hidden)
+
+    def __scroll_home(self):
+        #show the first rows of the output
+        buf=self.__text_buffers[self.__selected]
+        rows=0
+        idx=0
+        while idx<len(buf):
+            rows+=len(self.__wrap(buf.line(idx)))
+            if rows>=self.term_height:
+                self.__term_scroll[self.__selected]=(idx, rows-self.term_height)
+                return
+            idx+=1
+        self.__term_scroll[self.__selected]=(None, 0)
+
+    def __scroll_to(self, idx):
+        #show line idx at the bottom of the screen
+        buf=self.__text_buffers[self.__selected]
+        self.__term_scroll[self.__selected]=(None, 0) if idx>=len(buf)-1 else (idx, 0)
+        if len(self.__rows(*self.__view()))<self.term_height:
+            self.__scroll_home()
+
+    def __find(self, older=True, current=False):
+        #jump to the next match of the search pattern, returns False if there is none
+        #with current, the bottom line of the view is searched as well
+        buf=self.__text_buffers[self.__selected]
+        bottom, hidden = self.__view()
+        if older:
+            idx=buf.find(self.__search_pattern, before=bottom+1 if current else bottom)
+        else:
+            idx=buf.find(self.__search_pattern, after=bottom)
+        if idx is None:
+            return False
+        self.__scroll_to(idx)
+        return True
 
     def run(self):
         #start curses loop
@@ -131,6 +239,7 @@ class CommandScreen(Thread):
         self.term_x=self.term_border_x+2
         self.term_y=self.term_border_y+1
         self.term=curses.newwin(self.term_height,self.term_width,self.term_y, self.term_x)
+        self.__shown=['']*self.term_height
         self.__draw_term()
 
         #finally draw the various windows
@@ -148,27 +257,37 @@ class CommandScreen(Thread):
 
         attr=self.topbar_attr|curses.A_REVERSE if self.focus == 'term' else self.topbar_attr
         text='Terminal' if not self.__selected < len(self.__lmenu_items) else self.__lmenu_items[self.__selected]
+        if self.__search is not None:
+            text='/'+self.__search
+        elif self.__search_pattern:
+            text+=' [/'+self.__search_pattern+']'
+        text=text[0:max(0, self.term_border_width-2)]
         self.topbar.addstr(0, self.term_x+max(0,(self.term_border_width-len(text))/2),text, attr)
 
         #request refresh
         self.refresh=True
 
+    def __mark_dirty(self):
+        self.__dirty.add(self.__selected)
+
     def __draw_term(self):
         if self.__selected < len(self.__text_buffers):
-            self.term.clear()
-            lock, buf = self.__text_buffers[self.__selected]
-            scroll_offset = self.__term_scroll[self.__selected]
-            with lock:
-                for idx in range(self.term_height):
-                    buf_idx=idx+scroll_offset
-                    if buf_idx>=len(buf):
-                        break
-                    line=buf[-1*(buf_idx+1)]
-                    line=line[0:min(self.term_width-1, len(line))]
-                    self.term.addstr(self.term_height-1-idx, 0, line)
+            self.__dirty.discard(self.__selected)
 
-            #request refresh
-            self.refresh=True
+            #the buffer only locks while single lines are read, so producers are not blocked by drawing
+            rows=self.__rows(*self.__view())
+            rows+=['']*(self.term_height-len(rows))
+
+            #redraw the rows that changed since the last frame
+            for row, line in enumerate(rows):
+                if self.__shown[row]!=line:
+                    self.term.move(row, 0)
+                    self.term.clrtoeol()
+                    self.term.addstr(row, 0, line)
+                    self.__shown[row]=line
+
+                    #request refresh
+                    self.refresh=True
 
     def __draw_lmenu(self):
         with self.l:
@@ -181,6 +300,30 @@ class CommandScreen(Thread):
             #request refresh
             self.refresh=True
 
+    def __search_key(self, c):
+        #incremental search: every change of the pattern searches again from where the search started
+        if c == 27:
+            #escape cancels the search and restores the view
+            self.__search=None
+            self.__term_scroll[self.__selected]=self.__search_start
+        elif c in [curses.KEY_ENTER, ord('\n'), ord('\r')]:
+            self.__search=None
+        elif c in [curses.KEY_BACKSPACE, 127, 8]:
+            self.__search=self.__search[0:-1]
+        elif 32<=c<127:
+            self.__search+=chr(c)
+        else:
+            return
+
+        if self.__search is not None:
+            self.__search_pattern=self.__search
+            self.__term_scroll[self.__selected]=self.__search_start
+            #the line at the bottom of the view when the search started is the first candidate
+            if self.__search:
+                self.__find(current=True)
+        self.__mark_dirty()
+        self.__draw_topbar()
+
     def loop(self, scr):
         #set screen object to this instance
         self.scr = scr
@@ -188,8 +331,9 @@ class CommandScreen(Thread):
         #disable cursor
         curses.curs_set(False)
 
-        #make getch non-blocking
-        scr.nodelay(1)
+        #getch waits at most one frame for input
+        scr.timeout(max(1, int(self.__frame_interval*1000)))
+        last_frame=0
 
         #loop processing input until we need to stop
         while not self.__stop:
@@ -198,6 +342,11 @@ class CommandScreen(Thread):
             #get key
             c=scr.getch()
 
+            #while searching, keys edit the search pattern
+            if self.__search is not None and c != -1:
+                self.__search_key(c)
+                c=-1
+
             #quit
             if c == ord('q'):
                 return 0
@@ -207,41 +356,33 @@ class CommandScreen(Thread):
                 if self.focus == 'lmenu':
                     self.__selected=0
                     self.__draw_lmenu()
-                    self.__draw_term()
+                    self.__mark_dirty()
                     self.__draw_topbar()
                 else:
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=max(0,len(buf)-self.term_height)
-                    self.__draw_term()
+                    self.__scroll_home()
+                    self.__mark_dirty()
 
             #end key
             elif c == curses.KEY_END:
                 if self.focus == 'lmenu':
                     self.__selected=len(self.__lmenu_items)-1
                     self.__draw_lmenu()
-                    self.__draw_term()
+                    self.__mark_dirty()
                 else:
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=0
-                    self.__draw_term()
+                    self.__term_scroll[self.__selected]=(None, 0)
+                    self.__mark_dirty()
 
             #page up
             elif c == curses.KEY_PPAGE:
                 if self.focus == 'term':
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=min(max(0,len(buf)-self.term_height),self.__term_scroll[self.__selected]+self.term_height)
-                    self.__draw_term()
+                    self.__scroll_up(self.term_height)
+                    self.__mark_dirty()
 
             #page down
             elif c == curses.KEY_NPAGE:
                 if self.focus == 'term':
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=max(0,self.__term_scroll[self.__selected]-self.term_height)
-                    self.__draw_term()
+                    self.__scroll_down(self.term_height)
+                    self.__mark_dirty()
 
 
             #arrow up
@@ -249,26 +390,22 @@ class CommandScreen(Thread):
                 if self.focus == 'lmenu':
                     self.__selected=max(0,self.__selected-1)
                     self.__draw_lmenu()
-                    self.__draw_term()
+                    self.__mark_dirty()
                     self.__draw_topbar()
                 else:
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=min(max(0,len(buf)-self.term_height),self.__term_scroll[self.__selected]+1)
-                    self.__draw_term()
+                    self.__scroll_up(1)
+                    self.__mark_dirty()
 
             #arrow down
             elif c == curses.KEY_DOWN or c == ord('j'):
                 if self.focus == 'lmenu':
                     self.__selected=min(len(self.__lmenu_items)-1,self.__selected+1)
                     self.__draw_lmenu()
-                    self.__draw_term()
+                    self.__mark_dirty()
                     self.__draw_topbar()
                 else:
-                    lock, buf = self.__text_buffers[self.__selected]
-                    with lock:
-                        self.__term_scroll[self.__selected]=max(0,self.__term_scroll[self.__selected]-1)
-                    self.__draw_term()
+                    self.__scroll_down(1)
+                    self.__mark_dirty()
 
             #arrow right
             elif c == curses.KEY_RIGHT or c == ord('l'):
@@ -282,6 +419,16 @@ class CommandScreen(Thread):
                     self.__lmenu_xoffset=max(0,self.__lmenu_xoffset-1)
                     self.refresh=True
 
+            #search the output of the selected tab, n and N jump to the next older and newer match
+            elif c == ord('/'):
+                self.__search=''
+                self.__search_start=self.__term_scroll[self.__selected]
+                self.__draw_topbar()
+
+            elif c == ord('n') or c == ord('N'):
+                if self.__search_pattern and self.__find(older=(c == ord('n'))):
+                    self.__mark_dirty()
+
             #TAB
             elif c ==ord('\t'):
                 self.focus = 'lmenu' if not self.focus=='lmenu' else 'term'
@@ -291,30 +438,34 @@ class CommandScreen(Thread):
             elif c == curses.KEY_RESIZE:
                 self.reset_screen=True
 
-            #give the CPU some breathing room
-            else:
-                #reset / init the screen
-                if self.reset_screen:
-                    self.__reset_screen()
-                    scr.noutrefresh()
-                    self.lmenu_border.noutrefresh()
-                    self.term_border.noutrefresh()
-                    self.refresh=True
-                    with self.l:
-                        self.reset_screen=False
-
-                #refresh if required
-                if self.refresh:
-                    self.topbar.nooutrefresh()
-                    self.lmenu.noutrefresh(self.__selected-(self.lmenu_height),self.__lmenu_xoffset,self.lmenu_y,self.lmenu_x,self.lmenu_y+self.lmenu_height,self.lmenu_width)
-                    self.term.noutrefresh()
-                    curses.doupdate()
-                    with self.l:
-                        self.refresh=False
-                        self.__init_done=True
-                else:
-                    #absolutely nothing to do, rest for a while
-                    sleep(0.05)
+            #draw at most one frame per frame interval, however fast text or keys arrive
+            if time()-last_frame<self.__frame_interval:
+                continue
+            last_frame=time()
+
+            #reset / init the screen
+            if self.reset_screen:
+                self.__reset_screen()
+                scr.noutrefresh()
+                self.lmenu_border.noutrefresh()
+                self.term_border.noutrefresh()
+                self.refresh=True
+                with self.l:
+                    self.reset_screen=False
+
+            #only the selected tab is visible
+            if self.__selected in self.__dirty:
+                self.__draw_term()
+
+            #refresh if required
+            if self.refresh:
+                self.topbar.nooutrefresh()
+                self.lmenu.noutrefresh(self.__selected-(self.lmenu_height),self.__lmenu_xoffset,self.lmenu_y,self.lmenu_x,self.lmenu_y+self.lmenu_height,self.lmenu_width)
+                self.term.noutrefresh()
+                curses.doupdate()
+                with self.l:
+                    self.refresh=False
+                    self.__init_done=True
 
 
     def stop(self):
@@ -323,6 +474,12 @@ class CommandScreen(Thread):
         #wait max 5 seconds for all threads to terminate
         self.join(timeout=5)
 
+        #scrollback in a temporary directory is only kept while the screen runs
+        for buf in self.__text_buffers:
+            buf.close()
+        if self.__scrollback_tmp:
+            shutil.rmtree(self.__scrollback_dir, ignore_errors=True)
+
     def join(self, timeout=-1):
         try:
             while self.isAlive():
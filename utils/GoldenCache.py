@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import numpy as np
+import logging
+import shutil
+import json
+import os
+
+from digest import cached_file_digest, settings_digest, combine, write_atomic
+from blobdump import write_binary
+
+class GoldenCache(object):
+    #content addressed cache of reference outputs, with least recently used eviction
+    #
+    #every entry is a directory named after the hash of all inputs of the reference run:
+    #   <key>/prob.npy      output of the network
+    #   <key>/buffers.*     optional binary dump of all blobs (see blobdump.write_binary)
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.log = logging.getLogger()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        #hashing a caffemodel of hundreds of MB is not free, so digests are remembered by path, mtime and size
+        self.digests_file = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(self.digests_file, 'rt') as f:
+                self.digests = json.load(f)
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def digest(self, fname):
+        digest, computed = cached_file_digest(fname, self.digests)
+        if computed:
+            write_atomic(self.digests_file, json.dumps(self.digests))
+        return digest
+
+    def key(self, prototxt, caffemodel, image, settings):
+        return combine(self.digest(prototxt), self.digest(caffemodel), self.digest(image), settings_digest(settings))
+
+    def __entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, buffers=False):
+        #returns (prob, buffer manifest or None), or None on a miss
+        entry = self.__entry(key)
+        manifest = os.path.join(entry, 'buffers.json')
+        if not os.path.exists(os.path.join(entry, 'prob.npy')):
+            return None
+        if buffers and not os.path.exists(manifest):
+            return None
+
+        #mark as recently used
+        os.utime(entry, None)
+
+        self.log.debug("Golden cache hit for %s"%(key))
+        return np.load(os.path.join(entry, 'prob.npy')), (manifest if buffers else None)
+
+    def put(self, key, prob, buffers=None):
+        entry = self.__entry(key)
+
+        #build the entry next to its final location and move it in place in one step
+        tmp = entry+'.%d.tmp'%(os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'prob.npy'), prob)
+        if buffers is not None:
+            write_binary(os.path.join(tmp, 'buffers.bin'), buffers)
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        self.log.debug("Stored %s in golden cache"%(key))
+
+        self.evict()
+
+    def __size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, fname)) for fname in os.listdir(entry))
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+
+        #oldest used entries first
+        entries=[]
+        for name in os.listdir(self.cache_dir):
+            entry = self.__entry(name)
+            if os.path.isdir(entry) and not name.endswith('.tmp'):
+                entries.append((os.path.getmtime(entry), self.__size(entry), entry))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            self.log.info("Evicting %s from golden cache"%(os.path.basename(entry)))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+from threading import Lock
+from time import strftime
+import sys
+
+class HeadlessScreen(object):
+    #drop-in replacement of CommandScreen without a terminal, e.g. for cron jobs or continuous integration
+    #every line is printed as a plain log line, prefixed with the time and the name of its tab
+
+    def __init__(self, stream=sys.stdout):
+        self.stream=stream
+        self.l=Lock()
+        self.__tabs=[]
+
+    def add_tab(self, name):
+        with self.l:
+            self.__tabs+=[name]
+            #return handle
+            return len(self.__tabs)-1
+
+    def print_text(self, handle, text):
+        prefix='%s [%s] '%(strftime('%Y-%m-%d %H:%M:%S'), self.__tabs[handle])
+        with self.l:
+            for line in text.rstrip('\n').split('\n'):
+                self.stream.write(prefix+line+'\n')
+            self.stream.flush()
+
+    def isAlive(self):
+        #there is no user interface to wait for
+        return False
+
+    def stop(self):
+        pass
+
+    def join(self, timeout=-1):
+        pass
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+from threading import Lock
+try:
+    #python3
+    from socketserver import UnixStreamServer, ThreadingMixIn, StreamRequestHandler
+except:
+    #python 2
+    from SocketServer import UnixStreamServer, ThreadingMixIn, StreamRequestHandler
+import socket
+import base64
+import json
+import logging
+import os
+
+import caffe
+import numpy as np
+
+from inference import load_net, create_transformer, output_blob
+
+def network_name(prototxt):
+    #networks are addressed by the basename of their prototxt, e.g. vgg16/vgg16.prototxt -> vgg16
+    return os.path.splitext(os.path.basename(prototxt))[0]
+
+def encode_blob(data):
+    data = np.ascontiguousarray(data)
+    return {
+        "shape": list(data.shape),
+        "dtype": data.dtype.str,
+        "data": base64.b64encode(data.tobytes()).decode('ascii'),
+    }
+
+def decode_blob(desc):
+    return np.frombuffer(base64.b64decode(desc['data']), dtype=np.dtype(str(desc['dtype']))).reshape(desc['shape'])
+
+class Network(object):
+    #a caffe network which stays resident for the lifetime of the server
+
+    def __init__(self, prototxt, caffemodel, scale=1.0):
+        self.net = load_net(prototxt, caffemodel)
+        self.transformer = create_transformer(self.net, scale=scale)
+        self.output = output_blob(self.net)
+
+        #caffe nets are not thread safe, only one forward pass at a time
+        self.lock = Lock()
+
+    def infer(self, image, blobs=[], probabilities=False):
+        #decoding and preprocessing can be done outside the lock
+        transformed_image = self.transformer.preprocess('data', caffe.io.load_image(image))
+
+        with self.lock:
+            self.net.blobs['data'].data[...] = transformed_image
+            output = self.net.forward()
+            output_prob = output[self.output][0].reshape(-1)
+
+            #copy the requested blobs while we still hold the lock, the next request will overwrite them
+            argmax = int(output_prob.argmax())
+            response = {
+                "argmax": argmax,
+                "value": float(output_prob[argmax]),
+            }
+            if probabilities:
+                response['probabilities'] = output_prob.tolist()
+            if blobs:
+                response['blobs'] = dict( (name, encode_blob(self.net.blobs[name].data)) for name in blobs )
+
+        return response
+
+class RequestHandler(StreamRequestHandler):
+    #one json request per line, answered with one json response per line
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            try:
+                request = json.loads(line)
+                response = self.server.process(request)
+            except Exception as e:
+                response = {"error": "%s: %s"%(type(e).__name__, str(e))}
+
+            self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+            self.wfile.flush()
+
+class InferenceServer(ThreadingMixIn, UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, networks, logger=None):
+        self.log = logger or logging.getLogger()
+        self.socket_path = socket_path
+
+        #load all networks once
+        self.networks = {}
+        for name, prototxt, caffemodel, scale in networks:
+            self.log.info("Loading network %s from %s and %s"%(name, prototxt, caffemodel))
+            self.networks[name] = Network(prototxt, caffemodel, scale=scale)
+
+        #remove stale socket of a previous server
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        self.log.info("Listening on %s"%(socket_path))
+
+    def process(self, request):
+        command = request.get('command', 'infer')
+
+        if command == 'list':
+            return {"networks": sorted(self.networks.keys())}
+
+        if command == 'infer':
+            name = request.get('network')
+            if name is None and len(self.networks)==1:
+                name = list(self.networks.keys())[0]
+            if name not in self.networks:
+                raise KeyError("unknown network %s, loaded networks are %s"%(name, ', '.join(sorted(self.networks.keys()))))
+
+            self.log.debug("Inference of %s on network %s"%(request['image'], name))
+            return self.networks[name].infer(
+                request['image'],
+                blobs=request.get('blobs', []),
+                probabilities=request.get('probabilities', False),
+            )
+
+        raise ValueError("unknown command %s"%(command))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+class InferenceClient(object):
+    #keeps one connection open to the server for any number of requests
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.f = self.sock.makefile('rwb')
+
+    def request(self, **request):
+        self.f.write((json.dumps(request)+'\n').encode('utf-8'))
+        self.f.flush()
+        response = json.loads(self.f.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def infer(self, image, network=None, blobs=[], probabilities=False):
+        response = self.request(command='infer', image=os.path.abspath(image), network=network, blobs=blobs, probabilities=probabilities)
+        if 'blobs' in response:
+            response['blobs'] = dict( (name, decode_blob(desc)) for name, desc in response['blobs'].items() )
+        return response
+
+    def networks(self):
+        return self.request(command='list')['networks']
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Reference inference server which keeps caffe networks resident")
+
+    # Add verbose levels
+    _LOG_LEVEL_STRINGS = ['ERROR','WARNING', 'INFO', 'DEBUG']
+    def _log_level_string_to_int(log_level_string):
+        if not log_level_string in _LOG_LEVEL_STRINGS:
+            message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, _LOG_LEVEL_STRINGS)
+            raise argparse.ArgumentTypeError(message)
+        log_level_int = getattr(logging, log_level_string, logging.ERROR)
+        # check the logging log_level_choices have not changed from our expected values
+        assert isinstance(log_level_int, int)
+        return log_level_int
+    parser.add_argument('--log-level',
+    	default='INFO',
+    	dest='log_level',
+    	type=_log_level_string_to_int,
+    	nargs='?',
+    	help='Set the logging output level. {0}'.format(_LOG_LEVEL_STRINGS)
+    )
+
+    #other arguments
+    parser.add_argument('-S', '--socket', dest='socket', required=True,
+        help="Path of the unix socket to listen on",
+    )
+    parser.add_argument('--network', dest='networks', required=True, action='append', nargs='+', metavar='PROTOTXT CAFFEMODEL [SCALE]',
+        help="Network to load, can be given multiple times. Clients select the network by the basename of the prototxt",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    networks=[]
+    for net in args.networks:
+        if len(net) not in [2, 3]:
+            parser.error("--network expects PROTOTXT CAFFEMODEL [SCALE]")
+        prototxt, caffemodel = net[:2]
+        scale = float(net[2]) if len(net)==3 else 1.0
+        networks.append((network_name(prototxt), prototxt, caffemodel, scale))
+
+    with InferenceServer(args.socket, networks) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
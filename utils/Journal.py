@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+from threading import Lock
+from time import time
+import json
+import os
+
+from digest import file_digest
+
+class Journal(object):
+    #append-only record of queued/started/finished/failed events of the tasks of a command file
+    #every event is flushed to disk before continuing, so the journal survives a crash of the driver
+    #
+    #the first line identifies the command file, a journal of a different (e.g. regenerated) command file is discarded
+
+    def __init__(self, fname, cmd_file, resume=True):
+        self.fname=fname
+        self.lock=Lock()
+
+        #last event of every command in the journal
+        self.state={}
+
+        header={"cmd_file": os.path.abspath(cmd_file), "digest": file_digest(cmd_file)}
+        if resume and os.path.exists(fname):
+            with open(fname, 'rt') as f:
+                lines=f.readlines()
+            if lines and self.__parse(lines[0])==header:
+                for line in lines[1:]:
+                    event=self.__parse(line)
+                    if event:
+                        self.__update(event)
+                self.f=open(fname, 'at')
+                return
+
+        #start a new journal
+        self.f=open(fname, 'wt')
+        self.__write(header)
+
+    def __parse(self, line):
+        #the last line may be incomplete if we crashed while writing it
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def __write(self, entry):
+        self.f.write(json.dumps(entry, sort_keys=True)+'\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def record(self, event, command, **fields):
+        entry=dict(fields, event=event, command=command, time=time())
+        with self.lock:
+            self.__write(entry)
+            self.__update(entry)
+
+    def __update(self, entry):
+        #a cancelled copy of a task does not change the result of the task
+        if entry['event']!='cancelled':
+            self.state[entry['command']]=entry
+
+    def finished(self, command):
+        #a command is done if its last attempt finished successfully, started and failed commands are run again
+        return self.state.get(command, {}).get('event')=='finished'
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_command(line):
+    #commands can declare their files in trailing shell comments, which the shell ignores when executing the line:
+    #   <command> # inputs: <file> <file> ... # outputs: <file> <file> ...
+    command=line
+    declared={'inputs': [], 'outputs': []}
+    for kind in declared.keys():
+        marker=' # %s:'%(kind)
+        if marker in line:
+            declared[kind]=line.split(marker, 1)[1].split(' # ')[0].split()
+            command=command.split(marker, 1)[0]
+    return command.strip(), declared['inputs'], declared['outputs']
+
+def up_to_date(inputs, outputs):
+    #true if all declared outputs exist and are newer than all declared inputs
+    if not outputs or not all(os.path.exists(fname) for fname in outputs):
+        return False
+    if not all(os.path.exists(fname) for fname in inputs):
+        return False
+    oldest_output=min(os.path.getmtime(fname) for fname in outputs)
+    return all(os.path.getmtime(fname)<=oldest_output for fname in inputs)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import logging
+import os
+
+import caffe
+
+from digest import file_digest, settings_digest, combine, atomic_open
+
+def transform_settings(shape, scale=1.0):
+    #all parameters of the input transformation, used to build transformers and as part of the cache key
+    #the batch size does not change the transformation of a single image
+    return {
+        "shape": [1]+list(shape[1:]),
+        "transpose": [2,0,1],                   # move image channels to outermost dimension
+        "raw_scale": 255.0,                     # rescale from [0, 1] to [0, 255]
+        "mean": [103.939,116.779,123.68],       # subtract the dataset-mean value in each channel (RGB)
+        "channel_swap": [2,1,0],                # swap channels from RGB to BGR
+        "input_scale": scale,
+    }
+
+def build_transformer(settings):
+    # Create transformer for the input called 'data'
+    transformer = caffe.io.Transformer({'data': tuple(settings['shape'])})
+    transformer.set_transpose('data', tuple(settings['transpose']))
+    transformer.set_raw_scale('data', settings['raw_scale'])
+    transformer.set_mean('data', np.array(settings['mean']))
+    transformer.set_channel_swap('data', tuple(settings['channel_swap']))
+    transformer.set_input_scale('data', settings['input_scale'])
+    return transformer
+
+#state of each worker process, set once by the pool initializer
+_worker = {}
+
+def _init_worker(settings, cache_dir):
+    _worker['transformer'] = build_transformer(settings)
+    _worker['settings'] = settings_digest(settings)
+    _worker['cache_dir'] = cache_dir
+
+def _preprocess(fname):
+    cache_dir = _worker['cache_dir']
+
+    #preprocessed tensors are cached by image content and transformer settings
+    if cache_dir:
+        cached = os.path.join(cache_dir, combine(file_digest(fname), _worker['settings'])+'.npy')
+        if os.path.exists(cached):
+            return np.load(cached)
+
+    data = _worker['transformer'].preprocess('data', caffe.io.load_image(fname))
+
+    if cache_dir:
+        with atomic_open(cached, 'wb') as f:
+            np.save(f, data)
+
+    return data
+
+class Preprocessor(object):
+    #decodes and transforms images in a process pool, ahead of the consumer
+
+    def __init__(self, settings, workers=0, prefetch=32, cache_dir=None):
+        self.log = logging.getLogger()
+        self.prefetch = max(1, prefetch)
+
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        #without workers everything runs in the calling process
+        if workers > 0:
+            self.pool = Pool(workers, initializer=_init_worker, initargs=(settings, cache_dir))
+        else:
+            self.pool = None
+            _init_worker(settings, cache_dir)
+
+    def map(self, images):
+        #yields (image, tensor) in input order
+        if not self.pool:
+            for fname in images:
+                yield fname, _preprocess(fname)
+            return
+
+        #bounded prefetch queue, at most 'prefetch' images are in flight or waiting to be consumed
+        pending = deque()
+        images = iter(images)
+        for fname in images:
+            pending.append((fname, self.pool.apply_async(_preprocess, (fname,))))
+            if len(pending) >= self.prefetch:
+                break
+
+        while pending:
+            fname, result = pending.popleft()
+            data = result.get()
+
+            #refill the queue before handing out the result so the workers stay busy
+            for next_fname in images:
+                pending.append((next_fname, self.pool.apply_async(_preprocess, (next_fname,))))
+                break
+
+            yield fname, data
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type and self.pool:
+            self.pool.terminate()
+        self.close()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+from threading import Lock
+from time import sleep, time
+import json
+
+from digest import write_atomic
+
+#upper bounds in seconds of the buckets of the task duration histogram
+DURATION_BUCKETS=[1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, float('inf')]
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+class QueueMetrics(object):
+    #aggregate numbers of a ServerQueue run: queue depth, throughput, time spent per host and task durations
+    #with a prefix, <prefix>.json and <prefix>.prom (prometheus text format) are rewritten every interval seconds
+
+    def __init__(self, sq, prefix=None, interval=10):
+        self.sq=sq
+        self.prefix=prefix
+        self.interval=interval
+        self.lock=Lock()
+        self.start=time()
+
+        self.completed={'success': 0, 'failed': 0}
+        self.attempts=0
+        self.retries=0
+        self.quarantined=0
+        self.speculated=0
+        self.histogram=[0]*len(DURATION_BUCKETS)
+        self.duration_sum=0.0
+
+        #per host: seconds spent on tasks and in penalty, attempts and failed attempts
+        self.hosts={}
+
+        #per host: slot seconds until the last change of its active slots, and the time of that change
+        self.slot_seconds={}
+
+    def __host(self, host):
+        return self.hosts.setdefault(host, {'busy': 0.0, 'penalized': 0.0, 'attempts': 0, 'failed': 0})
+
+    def record_attempt(self, host, task, start, end, status):
+        with self.lock:
+            self.attempts+=1
+            #called before the attempt is added to the task, so earlier attempts make this one a retry
+            if task.attempts:
+                self.retries+=1
+            h=self.__host(host)
+            h['busy']+=end-start
+            h['attempts']+=1
+            if status!=0:
+                h['failed']+=1
+
+    def record_penalty(self, host, seconds):
+        with self.lock:
+            self.__host(host)['penalized']+=seconds
+
+    def record_slots(self, host, slots):
+        #called before an adaptive host changes its active slots, with the number of slots that were active until now
+        now=time()
+        with self.lock:
+            seconds, since = self.slot_seconds.get(host, (0.0, self.start))
+            self.slot_seconds[host]=(seconds+slots*(now-since), now)
+
+    def record_quarantine(self, task):
+        with self.lock:
+            self.quarantined+=1
+
+    def record_speculation(self, task):
+        with self.lock:
+            self.speculated+=1
+
+    def record_completed(self, task):
+        #the final result of a task, retries are not counted
+        with self.lock:
+            self.completed['success' if task.success else 'failed']+=1
+            duration=task.duration or 0.0
+            self.duration_sum+=duration
+            for idx, bound in enumerate(DURATION_BUCKETS):
+                if duration<=bound:
+                    self.histogram[idx]+=1
+                    break
+
+    def snapshot(self):
+        now=time()
+        elapsed=now-self.start
+        with self.lock:
+            done=sum(self.completed.values())
+            hosts={}
+            for host in self.sq.hosts:
+                h=dict(self.__host(host.host))
+                #active slots of a host are idle when they neither run a task nor sit out a penalty
+                h['slots']=host.slots
+                h['active_slots']=host.active_slots
+                h['running']=host.running
+                seconds, since = self.slot_seconds.get(host.host, (0.0, self.start))
+                h['idle']=max(0.0, seconds+host.active_slots*(now-since)-h['busy']-h['penalized'])
+                hosts[host.host]=h
+
+            cumulative=[]
+            total=0
+            for bound, count in zip(DURATION_BUCKETS, self.histogram):
+                total+=count
+                cumulative.append(('+Inf' if bound==float('inf') else bound, total))
+
+            return {
+                "time": now,
+                "elapsed": elapsed,
+                "queue_depth": self.sq.Q.qsize(),
+                "pending": self.sq.pending_tasks,
+                "completed": dict(self.completed),
+                "tasks_per_second": done/elapsed if elapsed>0 else 0.0,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "quarantined": self.quarantined,
+                "speculated": self.speculated,
+                "duration": {"sum": self.duration_sum, "count": done, "buckets": cumulative},
+                "hosts": hosts,
+            }
+
+    def prometheus(self, snap):
+        lines=[]
+        def metric(name, kind, help, samples):
+            lines.append('# HELP serverqueue_%s %s'%(name, help))
+            lines.append('# TYPE serverqueue_%s %s'%(name, kind))
+            for labels, value in samples:
+                labels=','.join('%s="%s"'%(k, label(v)) for k, v in labels)
+                lines.append('serverqueue_%s%s %s'%(name, '{'+labels+'}' if labels else '', repr(float(value))))
+
+        metric('queue_depth', 'gauge', 'Tasks waiting in the queue', [((), snap['queue_depth'])])
+        metric('pending_tasks', 'gauge', 'Tasks waiting or running', [((), snap['pending'])])
+        metric('tasks_completed_total', 'counter', 'Tasks with a final result', [ ((('status', k),), v) for k, v in sorted(snap['completed'].items()) ])
+        metric('task_attempts_total', 'counter', 'Executions of tasks, including retries', [((), snap['attempts'])])
+        metric('task_retries_total', 'counter', 'Executions of tasks that failed before', [((), snap['retries'])])
+        metric('tasks_quarantined_total', 'counter', 'Tasks given up on after repeated failures', [((), snap['quarantined'])])
+        metric('tasks_speculated_total', 'counter', 'Speculative copies of tasks that ran longer than expected', [((), snap['speculated'])])
+
+        lines.append('# HELP serverqueue_task_duration_seconds Duration of the final attempt of completed tasks')
+        lines.append('# TYPE serverqueue_task_duration_seconds histogram')
+        for bound, count in snap['duration']['buckets']:
+            lines.append('serverqueue_task_duration_seconds_bucket{le="%s"} %d'%(bound, count))
+        lines.append('serverqueue_task_duration_seconds_sum %s'%(repr(snap['duration']['sum'])))
+        lines.append('serverqueue_task_duration_seconds_count %d'%(snap['duration']['count']))
+
+        hosts=sorted(snap['hosts'].items())
+        metric('host_seconds_total', 'counter', 'Slot seconds of a host per state', [ ((('host', host), ('state', state)), h[state]) for host, h in hosts for state in ['busy', 'idle', 'penalized'] ])
+        metric('host_slots', 'gauge', 'Active slots of a host', [ ((('host', host),), h['active_slots']) for host, h in hosts ])
+        metric('host_running_tasks', 'gauge', 'Tasks running on a host', [ ((('host', host),), h['running']) for host, h in hosts ])
+        metric('host_failed_attempts_total', 'counter', 'Failed executions of tasks on a host', [ ((('host', host),), h['failed']) for host, h in hosts ])
+        return '\n'.join(lines)+'\n'
+
+    def write(self):
+        snap=self.snapshot()
+        write_atomic(self.prefix+'.json', json.dumps(snap, sort_keys=True, indent=4))
+        write_atomic(self.prefix+'.prom', self.prometheus(snap))
+
+    def run(self):
+        while self.sq.active:
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                self.sq.warning('Failed to write metrics: %s'%(str(e)))
+            for _ in xrange(self.interval):
+                if not self.sq.active:
+                    return
+                sleep(1)
+
+    def summary(self):
+        #human readable report of the run
+        snap=self.snapshot()
+        done=snap['duration']['count']
+        lines=[
+            'Processed %d tasks in %.1f seconds (%.2f tasks/s): %d succeeded, %d failed, %d quarantined, %d retries, %d speculative copies'%(
+                done, snap['elapsed'], snap['tasks_per_second'], snap['completed']['success'], snap['completed']['failed'], snap['quarantined'], snap['retries'], snap['speculated']),
+        ]
+        if done:
+            lines.append('Mean task duration %.1f seconds'%(snap['duration']['sum']/done))
+        for host, h in sorted(snap['hosts'].items()):
+            total=h['busy']+h['idle']+h['penalized'] or 1.0
+            lines.append('%s: %d attempts, %d failed, busy %d%%, idle %d%%, penalized %d%%'%(
+                host, h['attempts'], h['failed'], 100*h['busy']/total, 100*h['idle']/total, 100*h['penalized']/total))
+        return lines
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import json
+import glob
+import re
+import os
+
+from digest import write_atomic
+from stats import median
+
+#commands generated by the %_remote.cmd target: nice -n 10 make -C <network dir> memsize_<idx>.csv
+MAKE_DIR_RE=re.compile(r'make\s+(?:.*\s)?-C\s*(?P<dir>\S+)')
+POINT_IDX_RE=re.compile(r'(?:memsize|accesses)_(?P<idx>\d+)\.csv')
+
+def network_dir(command):
+    m=MAKE_DIR_RE.search(command)
+    return m.group('dir') if m else os.getcwd()
+
+def network_name(command):
+    return os.path.basename(os.path.normpath(network_dir(command)))
+
+class RuntimeHistory(object):
+    #runtimes of previously executed commands, stored per network as json
+
+    def __init__(self, fname, keep=5):
+        self.fname=fname
+        self.keep=keep
+        try:
+            with open(fname, 'rt') as f:
+                self.runtimes=json.load(f)
+        except (IOError, ValueError):
+            self.runtimes={}
+
+        #cost estimates of the points of each network directory, loaded on demand
+        self.points={}
+
+    def record(self, command, duration):
+        #only the most recent runs are kept so the estimate follows changes of the servers
+        runs=self.runtimes.setdefault(network_name(command), {}).setdefault(command, [])
+        runs.append(duration)
+        del runs[:-self.keep]
+
+    def save(self):
+        write_atomic(self.fname, json.dumps(self.runtimes, sort_keys=True, indent=4))
+
+    def runtime(self, command):
+        runs=self.runtimes.get(network_name(command), {}).get(command)
+        return median(runs) if runs else None
+
+    def cost(self, command):
+        #(accesses, buffer_size) predicted by the DSE for the point this command measures, or None
+        m=POINT_IDX_RE.search(command)
+        if not m:
+            return None
+
+        path=network_dir(command)
+        if path not in self.points:
+            self.points[path]=None
+            for fname in glob.glob(os.path.join(path, '*_points.json')):
+                with open(fname, 'rt') as f:
+                    self.points[path]=json.load(f)
+
+        points=self.points[path]
+        idx=int(m.group('idx'))
+        if not points or idx>=len(points):
+            return None
+        c=points[idx]['networkcost']
+        return (c['accesses'], c['buffer_size'])
+
+    def estimates(self, commands):
+        #estimated runtime of every command, None if nothing is known
+        #commands without history are estimated from their predicted accesses, scaled by the runtime per access of
+        #commands of the same network that did run before
+        costs=dict( (command, self.cost(command)) for command in commands )
+        runtimes=dict( (command, self.runtime(command)) for command in commands )
+
+        scale={}
+        for command in commands:
+            if runtimes[command] is not None and costs[command] and costs[command][0]>0:
+                scale.setdefault(network_name(command), []).append(runtimes[command]/float(costs[command][0]))
+        scale=dict( (network, median(values)) for network, values in scale.items() )
+
+        estimates={}
+        for command in commands:
+            if runtimes[command] is not None:
+                estimates[command]=runtimes[command]
+            elif costs[command] and network_name(command) in scale:
+                estimates[command]=costs[command][0]*scale[network_name(command)]
+            else:
+                estimates[command]=None
+        return estimates, costs
+
+    def order(self, commands):
+        #longest processing time first:
+        # 1. commands nothing is known about keep their order and go first, they may well be the longest
+        # 2. commands with a (scaled) runtime estimate, longest first
+        # 3. commands with only a cost prediction and no runtime scale, most accesses first
+        estimates, costs = self.estimates(commands)
+        def key(item):
+            idx, command = item
+            if estimates[command] is not None:
+                return (1, -estimates[command], idx)
+            if costs[command]:
+                return (2, -costs[command][0], -costs[command][1], idx)
+            return (0, idx)
+        return [ command for idx, command in sorted(enumerate(commands), key=key) ]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from threading import Lock
+from collections import deque
+from bisect import bisect_right
+from array import array
+import mmap
+
+class Scrollback(object):
+    #append-only history of the lines of one tab, stored on disk so nothing is lost
+    #
+    #the start offset of every line is kept in an index, the most recent lines are also kept in memory
+    #older lines are read from a memory map of the file, so any line can be fetched without reading the lines before it
+
+    def __init__(self, fname, window=4096):
+        self.fname=fname
+        self.lock=Lock()
+        self.f=open(fname, 'w+b')
+        self.size=0
+
+        #start offset of every line in the file
+        self.offsets=array('L')
+
+        #the last lines, the lines shown while following the output
+        self.window=deque(maxlen=window)
+
+        #memory map of the file, remapped when lines beyond its end are read
+        self.mm=None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, text):
+        #split text in lines and append them, returns the number of lines
+        lines=text.split('\n')
+        data=''.join( line+'\n' for line in lines )
+        with self.lock:
+            #text that arrives after the screen stopped is dropped
+            if self.f.closed:
+                return 0
+            for line in lines:
+                self.offsets.append(self.size)
+                self.size+=len(line)+1
+                self.window.append(line)
+            self.f.write(data)
+            self.f.flush()
+        return len(lines)
+
+    def __map(self, end):
+        #memory map at least the first end bytes of the file, lock has to be held
+        if self.mm is None or len(self.mm)<end:
+            self.mm=mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm
+
+    def line(self, idx):
+        with self.lock:
+            n=len(self.offsets)
+            if idx>=n-len(self.window):
+                return self.window[idx-(n-len(self.window))]
+            start=self.offsets[idx]
+            end=self.offsets[idx+1]-1
+            return self.__map(end)[start:end]
+
+    def find(self, pattern, before=None, after=None):
+        #index of the last line before line 'before' or the first line after line 'after' that contains pattern, or None
+        #before may be the number of lines, to search all of them
+        with self.lock:
+            if not self.size or not pattern:
+                return None
+            offsets=self.offsets
+            mm=self.__map(self.size)
+            end=offsets[before] if before is not None and before<len(offsets) else self.size
+
+        #search without holding the lock, appends only add data after the part that is searched
+        if before is not None:
+            pos=mm.rfind(pattern, 0, end) if before>0 else -1
+        else:
+            pos=mm.find(pattern, offsets[after+1]) if after+1<len(offsets) else -1
+        if pos<0:
+            return None
+        return bisect_right(offsets, pos)-1
+
+    def close(self):
+        with self.lock:
+            if self.mm is not None:
+                self.mm.close()
+            self.f.close()
@@ -1,58 +1,444 @@
 #!/usr/bin/env python
-from threading import Thread, Lock
-from time import sleep
+from threading import Thread, Lock, Condition, Event
+from time import sleep, time
 try:
     #python3
-    from queue import Queue, Full
+    from queue import Queue, Full, Empty
 except:
     #python 2
-    from Queue import Queue, Full
+    from Queue import Queue, Full, Empty
+from collections import OrderedDict, deque
+import multiprocessing
+import subprocess
 import paramiko
 import logging
+import select
+import signal
+import traceback
+import socket
+import os
 
-from CommandScreen import CommandScreen
+from HeadlessScreen import HeadlessScreen
+from QueueMetrics import QueueMetrics
 
 #set paramiko to only warnings to avoid a lot of clutter
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
+#size of the reads from task output channels
+RECV_SIZE=64*1024
+
+#prefix of the line on stderr with which speculatively executed remote tasks announce their process id
+PID_MARKER='### pid '
+
+#exit status of tasks whose declared files could not be copied, like ssh reports its own errors
+STAGE_FAILED=255
+
+class Task(object):
+    #a command and its administration while it moves through the queue
+    #put() returns the task, so it doubles as a future for the result of the command
+
+    def __init__(self, command, task_id, log=None, inputs=[], outputs=[]):
+        self.command=command
+        self.id=task_id
+
+        #files the command declares to read and write
+        self.inputs=inputs
+        self.outputs=outputs
+
+        #all output of all attempts of this task is appended to this file
+        self.log=log
+
+        #result of the final attempt
+        self.exit_status=None
+        self.host=None
+        self.start=None
+        self.end=None
+
+        #(host, start, end, exit status) of every attempt
+        self.attempts=[]
+
+        self.__done=Event()
+
+    def __str__(self):
+        return self.command
+
+    def attempt(self, host, start, end, exit_status):
+        self.attempts.append((host, start, end, exit_status))
+        self.host, self.start, self.end, self.exit_status = host, start, end, exit_status
+
+    def finish(self):
+        self.__done.set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        #returns the exit status, or None if the task did not finish within the timeout
+        #waiting in short steps keeps the wait interruptible in python 2
+        deadline = None if timeout is None else time()+timeout
+        while not self.__done.wait(1.0):
+            if deadline is not None and time()>deadline:
+                return None
+        return self.exit_status
+
+    def failed_hosts(self):
+        return set( host for host, start, end, exit_status in self.attempts if exit_status!=0 )
+
+    @property
+    def duration(self):
+        return self.end-self.start if self.done() else None
+
+    @property
+    def success(self):
+        return self.exit_status==0
+
+class TaskOutput(object):
+    #output of a running task: appended to the log of the task, stdout is printed line by line and the tail of stderr is kept
+
+    def __init__(self, scr, host, task, scr_handle, stderr_lines=100, marker=None):
+        self.scr=scr
+        self.scr_handle=scr_handle
+        self.remaining={'stdout': '', 'stderr': ''}
+        self.stderr_tail=deque(maxlen=stderr_lines)
+
+        #with a marker, the first line of stderr holds the process id of the task instead of output
+        self.marker=marker
+        self.header=''
+        self.pid=None
+
+        self.log = open(task.log, 'ab') if task.log else None
+        if self.log:
+            self.log.write('### %s: %s\n'%(host.host, task.command))
+
+    def lines(self, stream, data):
+        #split data in complete lines, keep anything after the last newline for the next read
+        data=self.remaining[stream]+data
+        newline_idx=data.rfind('\n')
+        self.remaining[stream]=data[newline_idx+1:]
+        return data[0:newline_idx].split('\n') if newline_idx!=-1 else []
+
+    def process(self, stream, data):
+        if stream=='stderr' and self.marker and self.pid is None:
+            self.header+=data
+            if '\n' not in self.header:
+                return
+            line, data = self.header.split('\n', 1)
+            if line.startswith(self.marker):
+                self.pid=int(line[len(self.marker):])
+            else:
+                #not announced, the task can not be killed
+                self.pid=0
+                data=line+'\n'+data
+            if not data:
+                return
+
+        if self.log:
+            self.log.write(data)
+        for line in self.lines(stream, data):
+            if stream=='stdout':
+                if line.strip():
+                    self.scr.print_text(self.scr_handle, line)
+            else:
+                self.stderr_tail.append(line)
+
+    def stderr(self):
+        #flush incomplete last lines and return the tail of stderr
+        if self.remaining['stdout'].strip():
+            self.scr.print_text(self.scr_handle, self.remaining['stdout'])
+        if self.remaining['stderr']:
+            self.stderr_tail.append(self.remaining['stderr'])
+        self.remaining={'stdout': '', 'stderr': ''}
+        return '\n'.join(self.stderr_tail).strip()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+
+class Host(object):
+    #All slots of a host share their ssh connections, each slot runs its tasks in a separate channel
+    #sshd limits the number of sessions per connection (MaxSessions, 10 by default), so hosts with more slots use multiple connections
+    #one session of every connection is left free for load probes, sftp and killing speculative copies
+    local=False
+
+    def __init__(self, sq, host, username, slots, channels_per_connection=9, adaptive=False, min_slots=1, max_slots=None, probe_interval=30):
+        self.sq=sq
+        self.host=host
+        self.username=username
+        self.channels_per_connection=channels_per_connection
+
+        #adaptive hosts start with their minimum and grow or shrink within bounds depending on the load of the host
+        self.adaptive=adaptive
+        self.min_slots=min_slots
+        self.slots=max(slots, max_slots or 0)
+        self.active_slots=min(min_slots, self.slots) if adaptive else self.slots
+        self.probe_interval=probe_interval
+
+        #number of tasks this queue is running on the host, which is part of the load average of the host
+        self.running=0
+        self.slot_lock=Condition()
+
+        #distinct tasks that failed on this host since the last task that succeeded
+        self.failed_tasks=set()
+
+        n_connections=(self.slots+channels_per_connection-1)//channels_per_connection
+        self.connections=[ {'lock': Lock(), 'client': None, 'backoff': 8} for _ in range(n_connections) ]
+
+    def connection_index(self, slot):
+        return slot//self.channels_per_connection
+
+    def connect(self, idx):
+        #return the shared client of this connection, (re)connecting only if required
+        #slots waiting on the lock get the client of whichever slot connected first
+        conn=self.connections[idx]
+        with conn['lock']:
+            while self.sq.active:
+                client=conn['client']
+                if client is not None and client.get_transport() is not None and client.get_transport().is_active():
+                    return client
+
+                try:
+                    self.sq.debug('Trying to connect to: %s'%(self.host))
+                    client = paramiko.SSHClient()
+                    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                    client.connect(self.host, username=self.username)
+                    self.sq.debug('Established connection to: %s'%(self.host))
+                    conn['client']=client
+                    conn['backoff']=8
+                    return client
+
+                except (
+                    paramiko.ssh_exception.AuthenticationException,
+                    paramiko.ssh_exception.NoValidConnectionsError,
+                    paramiko.ssh_exception.SSHException,
+                    socket.error
+                ):
+                    client.close()
+                    if self.sq.active:
+                        self.sq.warning('Failed to connect to: %s'%(self.host))
+                        self.sq.warning('Retrying to connect to %s in %d seconds'%(self.host, conn['backoff']))
+
+                    #exponential backoff, but keep polling the active property
+                    for _ in xrange(conn['backoff']):
+                        if not self.sq.active:
+                            return None
+                        sleep(1)
+                    conn['backoff']*=2
+                    #maximum backoff of 10 minutes
+                    conn['backoff']=min(conn['backoff'], 600)
+        return None
+
+    def wait_slot(self, slot):
+        #slots beyond the number of active slots wait until the host grows again
+        with self.slot_lock:
+            while slot>=self.active_slots:
+                if not self.sq.active:
+                    return False
+                self.slot_lock.wait(1.0)
+        return self.sq.active
+
+    def task_started(self):
+        with self.slot_lock:
+            self.running+=1
+
+    def task_finished(self):
+        with self.slot_lock:
+            self.running-=1
+
+    def task_succeeded(self):
+        with self.slot_lock:
+            self.failed_tasks.clear()
+
+    def task_failed(self, task):
+        #returns true if the failure looks specific to this host:
+        #the host keeps failing different tasks, and this task did not fail on any other host
+        with self.slot_lock:
+            self.failed_tasks.add(task.id)
+            return len(self.failed_tasks)>=2 and task.failed_hosts()==set([self.host])
+
+    def probe(self):
+        #returns (cores, load average of the last minute, available memory fraction) of the host
+        client=self.connect(0)
+        if client is None:
+            return None
+        stdin, stdout, stderr = client.exec_command('nproc; cat /proc/loadavg; cat /proc/meminfo', timeout=30)
+        lines=stdout.read().split('\n')
+        nproc=int(lines[0])
+        loadavg=float(lines[1].split()[0])
+        meminfo=dict( (l.split(':')[0], int(l.split()[1])) for l in lines[2:] if ':' in l )
+        mem_free=meminfo.get('MemAvailable', meminfo.get('MemFree', 0))/float(meminfo['MemTotal'])
+        return nproc, loadavg, mem_free
+
+    def adapt(self):
+        #periodically resize the number of active slots to the capacity the host has left
+        while self.sq.active:
+            try:
+                probed=self.probe()
+            except Exception as e:
+                self.sq.warning('Failed to probe %s: %s'%(self.host, str(e)))
+                probed=None
+
+            if probed:
+                nproc, loadavg, mem_free = probed
+                with self.slot_lock:
+                    #our own tasks are part of the load average, the rest is load of other users
+                    other_load=max(0.0, loadavg-self.running)
+                    target=int(nproc-other_load)
+
+                    #do not grow when memory is getting scarce, and shrink when it is almost gone
+                    if mem_free<0.1:
+                        target=min(target, self.active_slots)
+                    if mem_free<0.05:
+                        target=min(target, self.active_slots-1)
+
+                    target=max(self.min_slots, min(self.slots, target))
+                    if target!=self.active_slots:
+                        self.sq.info('Host %s: %d cores, load %.1f, %d%% memory available. Changing from %d to %d slots'%(self.host, nproc, loadavg, int(mem_free*100), self.active_slots, target))
+                        self.sq.metrics.record_slots(self.host, self.active_slots)
+                        self.active_slots=target
+                        self.slot_lock.notify_all()
+
+            for _ in xrange(self.probe_interval):
+                if not self.sq.active:
+                    return
+                sleep(1)
+
+    def invalidate(self, idx, client):
+        #close a broken connection, unless another slot already replaced it
+        conn=self.connections[idx]
+        with conn['lock']:
+            if conn['client'] is client:
+                client.close()
+                conn['client']=None
+
+    def close(self):
+        for conn in self.connections:
+            if conn['client'] is not None:
+                conn['client'].close()
+
+class LocalHost(Host):
+    #The machine running the queue, tasks are executed as subprocesses so no ssh server or connection is involved
+    local=True
+
+    def connect(self, idx):
+        #there is nothing to connect to, the host itself serves as the client
+        return self if self.sq.active else None
+
+    def probe(self):
+        nproc=multiprocessing.cpu_count()
+        loadavg=os.getloadavg()[0]
+        with open('/proc/meminfo', 'rt') as f:
+            meminfo=dict( (l.split(':')[0], int(l.split()[1])) for l in f if ':' in l )
+        mem_free=meminfo.get('MemAvailable', meminfo.get('MemFree', 0))/float(meminfo['MemTotal'])
+        return nproc, loadavg, mem_free
+
+    def invalidate(self, idx, client):
+        pass
+
+    def close(self):
+        pass
+
 class ServerQueue(object):
     #Was supposed to be a direct subclass of queue but in python queue has some issues and can not be subclassed -_-
 
-    def __init__(self, servers, persistent=True, **kwargs):
+    def __init__(self, servers, persistent=True, channels_per_connection=9, log_dir=None, probe_interval=30, journal=None, max_retries=3, quarantine_hosts=2, headless=False, metrics=None, metrics_interval=10,
+            speculate=False, speculate_factor=1.5, expected=None, stager=None, **kwargs):
 
         #if persistent, tasks with a non-zero exit value will be requeued for processing
+        #a task is retried at most max_retries times, and given up on as soon as it failed on quarantine_hosts different hosts
+        #tasks that are given up on are quarantined and reported at the end
         self.persistent=persistent
+        self.max_retries=max_retries
+        self.quarantine_hosts=quarantine_hosts
+        self.quarantine=[]
 
-        #A timeout is given to hosts that fail a task
-        #Note that if there is a problem with the tasks, this can lead to a lot of idle workers and a queue filled with broken tasks!
+        #A timeout is given to hosts that fail a task, if the failure looks like a problem of the host and not of the task
         self.penalize_failing_hosts=True
 
+        #seconds a slot waits before its next task after a task could not be run, e.g. because the host refused a channel
+        self.retry_backoff=5
+
+        #with speculation, idle slots start a copy of tasks that run speculate_factor times longer than expected once the queue is empty
+        #the expected duration of a command comes from expected(command), or else from the median duration of the tasks of this run
+        #the first copy to succeed wins, the other copy is killed
+        #copies must not write the same files, so they only run when the stager found that both hosts have their own copy of the output directories
+        self.speculate=speculate
+        self.speculate_factor=speculate_factor
+        self.expected=expected
+
+        #optional Stager that copies the declared inputs and outputs of tasks to and from hosts without a shared file system
+        self.stager=stager
+
+        #running copies of every task by task id, and durations of tasks that succeeded
+        self.running={}
+        self.running_lock=Lock()
+        self.durations=[]
+
         #create logger
         #self.log=logging.getLogger('ServerQueue')
         self.loglevel=logging.getLogger().getEffectiveLevel()
-        self.scr = CommandScreen()
+        #without a terminal all output is printed as plain log lines
+        if headless:
+            self.scr = HeadlessScreen()
+        else:
+            #curses is only required for the interactive screen
+            from CommandScreen import CommandScreen
+            self.scr = CommandScreen(scrollback_dir=os.path.join(log_dir, 'screen') if log_dir else None)
         self.main_handle = self.scr.add_tab("Main")
 
         #notify user
         self.info("Starting Server Queue")
 
-        #init Queue to hold tasks
-        self.Q=Queue(maxsize=len(servers)*16, **kwargs)
 
         #keep track of how many tasks still need to be processed
+        #waiters are woken on every change instead of polling the counter
         self.pending_tasks=0
-        self.pending_tasks_lock=Lock()
+        self.pending_tasks_lock=Condition()
+
+        #finished tasks, in order of completion
+        self.completed=Queue()
+
+        #optional Journal to record the progress of all tasks
+        self.journal=journal
+
+        #every task gets an id, which also names its log file in log_dir
+        self.task_cnt=0
+        self.log_dir=log_dir
+        if log_dir and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+        #servers that are listed multiple times get multiple slots, which share their connections
+        #servers are (host, username) tuples, optionally followed by a dict with options for the Host
+        slots=OrderedDict()
+        options={}
+        for server_info in servers:
+            key=tuple(server_info[:2])
+            slots[key]=slots.get(key, 0)+1
+            if len(server_info)>2:
+                options[key]=server_info[2]
+        #hosts with the 'local' option run their tasks as subprocesses of this process instead of over ssh
+        self.hosts=[]
+        for (host, username), n in slots.items():
+            host_options=dict(options.get((host, username), {}))
+            cls=LocalHost if host_options.pop('local', False) else Host
+            self.hosts.append(cls(self, host, username, n, channels_per_connection=channels_per_connection, probe_interval=probe_interval, **host_options))
 
-        #Create list of workers
-        self.workers=[ Thread(target=self.worker, args=server_info) for server_info in servers]
+        #init Queue to hold tasks
+        self.Q=Queue(maxsize=sum(host.slots for host in self.hosts)*16, **kwargs)
+
+        #Create one worker per slot
+        self.workers=[ Thread(target=self.worker, args=(host, slot)) for host in self.hosts for slot in range(host.slots)]
+
+        #adaptive hosts get a thread that probes their load
+        self.workers+=[ Thread(target=host.adapt) for host in self.hosts if host.adaptive ]
+
+        #aggregate numbers of the run, periodically written to <metrics>.json and <metrics>.prom if a prefix is given
+        self.metrics=QueueMetrics(self, prefix=metrics, interval=metrics_interval)
+        if metrics:
+            self.workers+=[ Thread(target=self.metrics.run) ]
 
         #Set workers to Daemon mode to ensure they are terminated when the main thread exits
         [ w.setDaemon(True) for w in self.workers]
 
-        #list of all ssh clients / connections
-        self.client_lock=Lock()
-        self.clients=[]
-
     def print_main(self,msg):
         self.scr.print_text(self.main_handle, msg)
 
@@ -73,10 +459,6 @@ class ServerQueue(object):
         if self.loglevel<=logging.ERROR:
             self.print_main('ERR: '+msg)
 
-    def __add_client(self, conn):
-        with self.client_lock:
-            self.clients.append(conn)
-
     def __start_workers(self):
         #open connections to all servers
         self.active=True
@@ -89,79 +471,68 @@ class ServerQueue(object):
         except:
             raise AttributeError
 
-    def worker(self, host, username):
+    def worker(self, host, slot):
         #add tab to command screen
-        scr_handle=self.scr.add_tab(host)
+        scr_handle=self.scr.add_tab(host.host if host.slots==1 else '%s:%d'%(host.host, slot))
 
-        #setup paramiko ssh client
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.__add_client(client)
+        #slots share the connections of their host
+        conn_idx=host.connection_index(slot)
 
-        #exponential back off for retrying to connect start at 1 second
-        backoff=8
+        #local hosts run tasks as subprocesses, all other hosts over ssh
+        run=self.run_local if host.local else self.run_remote
 
         #failed task penalty
         penalty=0
 
-        def line_buffered(f):
-            #yield buffered lines
-            remaining=''
-            while not f.channel.exit_status_ready():
-                output = f.read(256)
-
-                #prefix output with whatever was remaining from previous iteration
-                output = remaining + output
-
-                #find the last newline
-                newline_idx=output.rfind('\n')
-
-                #everything after the last new line will be kept until next iteration
-                remaining=output[newline_idx+1:]
-
-                #if there was at least a valid newline, we can yield the output until the last newline
-                if newline_idx!=-1:
-                    yield output[0:newline_idx]
-                    #for line in output[0:newline_idx].split('\n'):
-                    #    yield line
-
-            #read whatever is left
-            yield remaining + f.read()
-
         while self.active:
-            try:
-                self.debug('Trying to connect to: %s'%(host))
-                client.connect(host, username=username)
-                self.debug('Established connection to: %s'%(host))
-                backoff=8
+            #connecting and backing off is handled per host
+            client=host.connect(conn_idx)
+            if client is None:
+                return
 
+            try:
                 #Keep processing tasks (unless there is an exception)
                 while self.active:
 
-                    task = self.get()
+                    #only take a task when this slot is active on the host
+                    if not host.wait_slot(slot):
+                        return
+
+                    task, speculative = self.next_task(host)
+                    if task is None:
+                        continue
+
+                    copy=self.copy_started(task, host, speculative)
+                    handled=False
                     try:
                         #Execute task on server
-                        self.info(host+': '+task)
-                        stdin, stdout, stderr = client.exec_command(task)
-
-                        #print stdout continuously
-                        for line in line_buffered(stdout):
-                            if line.strip():
-                                #self.info('-'*20+'\nHOST: '+host+':\n'+line+'\n'+'-'*20)
-                                self.scr.print_text(scr_handle, line)
+                        self.info(host.host+': '+task.command+(' (speculative copy)' if speculative else ''))
+                        self.record('started', task, host=host.host, speculative=speculative)
+                        host.task_started()
+                        try:
+                            status, stderr = run(client, host, task, scr_handle, copy)
+                        finally:
+                            host.task_finished()
+                        end=time()
+                        self.metrics.record_attempt(host.host, task, copy['start'], end, status)
+
+                        if not self.copy_finished(task, copy, status):
+                            #another copy of the task decides its result
+                            self.record('cancelled', task, host=host.host, exit_status=status)
 
                         #log stderr if required
-                        if stdout.channel.recv_exit_status()!=0:
-                            self.error('Host "'+host+'" had an error, see log of this host\n')
-                            self.scr.print_text(scr_handle, stderr.read().strip())
+                        elif status!=0:
+                            task.attempt(host.host, copy['start'], end, status)
+                            self.record('failed', task, host=host.host, exit_status=status)
 
+                            self.error('Host "'+host.host+'" had an error, see log of this host\n')
+                            self.scr.print_text(scr_handle, stderr)
+                            if task.log:
+                                self.error('Full output of task %d is in %s'%(task.id, task.log))
 
-                            #if we are persistent, we requeue tasks with a non-zero exit value
-                            if self.persistent:
-                                self.warning("Host %s failed task %s. REQUEUEING because PERSISTANT is set"%(host, task))
-                                self.put(task)
 
-                                #hosts that fail a task get exponential penalty
+                            #hosts that keep failing different tasks get exponential penalty
+                            if host.task_failed(task):
                                 if penalty==0:
                                     penalty=1
                                 else:
@@ -169,49 +540,278 @@ class ServerQueue(object):
 
                                 #max penalty of 10 minutes
                                 penalty=min(penalty,600)
-                                self.warning("Host %s failed task, timeout of %d seconds"%(host, penalty))
+                                self.warning("Host %s failed multiple tasks, timeout of %d seconds"%(host.host, penalty))
+
+                            #if we are persistent, we requeue tasks with a non-zero exit value, up to a limit
+                            if self.persistent:
+                                failed_hosts=task.failed_hosts()
+                                if len(failed_hosts)>=self.quarantine_hosts or len(task.attempts)>self.max_retries:
+                                    self.error("Task %d failed %d times on %d hosts, QUARANTINED: %s"%(task.id, len(task.attempts), len(failed_hosts), task.command))
+                                    self.record('quarantined', task, hosts=sorted(failed_hosts))
+                                    self.quarantine.append(task)
+                                    self.metrics.record_quarantine(task)
+                                    self.finish(task)
+                                else:
+                                    self.warning("Host %s failed task %s. REQUEUEING because PERSISTANT is set"%(host.host, task.command))
+                                    self.put(task)
+                            else:
+                                self.finish(task)
                         else:
+                            task.attempt(host.host, copy['start'], end, status)
+                            self.record('finished', task, host=host.host, exit_status=status)
+
                             penalty=0
+                            host.task_succeeded()
+                            self.finish(task)
+                        handled=True
 
-                    except:
+                    except Exception as e:
                         #if we fail whilst executing the task,
                         #put it back on the queue and report the current one as done
-                        self.put(task)
+                        #unless another copy of the task is still running or the result was already handled
+                        if self.copy_finished(task, copy, None) and not handled:
+                            self.put(task)
                         self.task_done()
 
-                        #Assume we failed due to bad connection, so close the connection
+                        #a refused channel (e.g. MaxSessions reached) leaves the shared connection intact
+                        if isinstance(e, paramiko.ssh_exception.ChannelException):
+                            self.warning('Host %s refused a channel for task %d, retrying later'%(host.host, task.id))
+
+                        #a broken transport closes the shared connection
                         #And pass to higher level try to trigger a reconnect
-                        client.close()
-                        raise paramiko.ssh_exception.SSHException
+                        elif isinstance(e, (paramiko.ssh_exception.SSHException, socket.error)):
+                            host.invalidate(conn_idx, client)
+                            raise paramiko.ssh_exception.SSHException
 
-                    #signal we processed our task
-                    self.task_done()
+                        #any other error is not the fault of the connection, keep using it
+                        else:
+                            self.error('Task %d could not run on %s, retrying later\n%s'%(task.id, host.host, traceback.format_exc()))
 
-                    #if our worker host failed we apply a penalty before accepting new tasks
-                    if self.penalize_failing_hosts:
-                        #exponential backoff, but keep polling the active property
-                        for _ in xrange(penalty):
+                        #back off before accepting new tasks, but keep polling the active property
+                        for _ in xrange(self.retry_backoff):
                             if not self.active:
                                 return
                             sleep(1)
+                        continue
+
+                    #signal we processed our task
+                    self.task_done()
 
-            except (
-                paramiko.ssh_exception.AuthenticationException,
-                paramiko.ssh_exception.NoValidConnectionsError,
-                paramiko.ssh_exception.SSHException
-            ):
+                    #if our worker host failed we apply a penalty before accepting new tasks
+                    if self.penalize_failing_hosts and penalty>0:
+                        #exponential backoff, but keep polling the active property
+                        penalty_start=time()
+                        try:
+                            for _ in xrange(penalty):
+                                if not self.active:
+                                    return
+                                sleep(1)
+                        finally:
+                            self.metrics.record_penalty(host.host, time()-penalty_start)
+
+            except paramiko.ssh_exception.SSHException:
                 if self.active:
-                    self.warning('Failed to connect to: %s'%(host))
-                    self.warning('Retrying to connect to %s in %d seconds'%(host, backoff))
+                    self.warning('Lost connection to: %s'%(host.host))
 
-                #exponential backoff, but keep polling the active property
-                for _ in xrange(backoff):
-                    if not self.active:
-                        return
-                    sleep(1)
-                backoff*=2
-                #maximum backoff of 10 minutes
-                backoff=min(backoff, 600)
+    def next_task(self, host):
+        #returns (task, speculative) or (None, False) if there is nothing to do yet
+        try:
+            return self.get(timeout=1.0), False
+        except Empty:
+            pass
+
+        #the queue is empty, so this slot is idle and can duplicate a straggler
+        if not self.speculate:
+            return None, False
+        task=self.straggler(host)
+        if task is None:
+            return None, False
+
+        #the copy is pending like any other task, so joining waits for it
+        with self.pending_tasks_lock:
+            self.pending_tasks+=1
+        self.metrics.record_speculation(task)
+        self.warning("Task %d runs longer than expected, starting a speculative copy on %s"%(task.id, host.host))
+        return task, True
+
+    def isolated(self, host, task):
+        #true if the host is known to write the outputs of the task to its own file system, which the stager copies back
+        #hosts the stager did not classify yet are not isolated
+        return self.stager is not None and not host.local and bool(task.outputs) and self.stager.isolated(host, task.outputs)
+
+    def expected_duration(self, task):
+        #expected runtime from the history of the command, or the median runtime of the tasks of this run
+        expected=self.expected(task.command) if self.expected else None
+        if expected is None:
+            with self.running_lock:
+                durations=sorted(self.durations)
+            if len(durations)<3:
+                return None
+            expected=durations[len(durations)//2]
+        return expected
+
+    def straggler(self, host):
+        #the running task that exceeds its expected duration the most, and is not duplicated yet
+        #both copies must write their outputs to a file system of their own
+        now=time()
+        with self.running_lock:
+            candidates=[ (task, copies[0]) for task, copies in self.running.values() if len(copies)==1 and copies[0]['host'] is not host ]
+
+        worst, worst_ratio = None, self.speculate_factor
+        for task, copy in candidates:
+            if not self.isolated(host, task) or not self.isolated(copy['host'], task):
+                continue
+            expected=self.expected_duration(task)
+            if not expected:
+                continue
+            ratio=(now-copy['start'])/expected
+            if ratio>worst_ratio:
+                worst, worst_ratio = task, ratio
+
+        #the task may have finished while we were looking
+        with self.running_lock:
+            if worst is not None and len(self.running.get(worst.id, (None, []))[1])==1:
+                return worst
+        return None
+
+    def copy_started(self, task, host, speculative):
+        #register a running copy of a task, copies with the cancelled flag set are killed by run_local or run_remote
+        copy={'host': host, 'start': time(), 'speculative': speculative, 'cancelled': False}
+        with self.running_lock:
+            self.running.setdefault(task.id, (task, []))[1].append(copy)
+        return copy
+
+    def copy_finished(self, task, copy, status):
+        #returns true if this copy decides the result of the task:
+        #the first copy that succeeds wins and cancels the others, a copy that fails only decides when it is the last one
+        with self.running_lock:
+            #a copy is only accounted for once, a later call (from the cleanup of a worker) gets the same answer
+            if 'decides' in copy:
+                return copy['decides']
+
+            copies=self.running[task.id][1]
+            copies.remove(copy)
+            if not copies:
+                del self.running[task.id]
+
+            if copy['cancelled']:
+                decides=False
+            elif status!=0:
+                decides=not copies
+            else:
+                self.durations.append(time()-copy['start'])
+                for other in copies:
+                    other['cancelled']=True
+                if copies:
+                    self.info("Task %d finished on %s, cancelling its other copies"%(task.id, copy['host'].host))
+                decides=True
+            copy['decides']=decides
+            return decides
+
+    def run_remote(self, client, host, task, scr_handle, copy):
+        #execute a task in a new channel and drain stdout and stderr concurrently as soon as data arrives
+        #returns the exit status and the last lines of stderr
+        if self.stager and task.outputs:
+            #speculation needs to know whether the outputs of the task end up on a file system of the host's own
+            try:
+                self.stager.probe(client, host, task.outputs)
+            except (IOError, OSError) as e:
+                return STAGE_FAILED, 'Failed to probe the output directories of task %d on %s: %s'%(task.id, host.host, str(e))
+
+        if self.stager and task.inputs:
+            try:
+                uploaded=self.stager.push(client, host, task.inputs)
+            except (IOError, OSError) as e:
+                return STAGE_FAILED, 'Failed to stage inputs of task %d on %s: %s'%(task.id, host.host, str(e))
+            self.debug('Staged inputs of task %d on %s, uploaded %d bytes'%(task.id, host.host, uploaded))
+
+        chan=client.get_transport().open_session()
+        if self.speculate:
+            #sshd starts the command in a new session, the first line of stderr tells the process group to kill on a cancel
+            chan.exec_command('echo "%s$$" >&2; %s'%(PID_MARKER, task.command))
+            output=TaskOutput(self.scr, host, task, scr_handle, marker=PID_MARKER)
+        else:
+            chan.exec_command(task.command)
+            output=TaskOutput(self.scr, host, task, scr_handle)
+
+        killed=False
+        try:
+            while True:
+                if copy['cancelled'] and not killed and output.pid:
+                    kill=None
+                    try:
+                        kill=client.get_transport().open_session()
+                        kill.exec_command('kill -TERM -- -%d'%(output.pid))
+                        kill.recv_exit_status()
+                        killed=True
+                    except paramiko.ssh_exception.SSHException:
+                        #sshd refuses sessions beyond MaxSessions, the copy keeps running until the next try
+                        self.debug('Could not open a session to kill task %d on %s, retrying'%(task.id, host.host))
+                    finally:
+                        if kill is not None:
+                            kill.close()
+
+                #the channel becomes readable when data arrives on either stream, the timeout catches the exit status
+                select.select([chan], [], [], 1.0)
+
+                while chan.recv_ready():
+                    output.process('stdout', chan.recv(RECV_SIZE))
+                while chan.recv_stderr_ready():
+                    output.process('stderr', chan.recv_stderr(RECV_SIZE))
+
+                if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                    break
+
+            status=chan.recv_exit_status()
+            stderr=output.stderr()
+        finally:
+            chan.close()
+            output.close()
+
+        #sftp needs a session of its own, so the outputs are retrieved after the channel of the task is closed
+        if status==0 and not copy['cancelled'] and self.stager and task.outputs:
+            try:
+                downloaded=self.stager.pull(client, host, task.outputs)
+            except (IOError, OSError) as e:
+                return STAGE_FAILED, (stderr+'\n' if stderr else '')+'Failed to retrieve outputs of task %d from %s: %s'%(task.id, host.host, str(e))
+            self.debug('Retrieved outputs of task %d from %s, downloaded %d bytes'%(task.id, host.host, downloaded))
+        return status, stderr
+
+    def run_local(self, client, host, task, scr_handle, copy):
+        #execute a task as a subprocess of this process, same interface as run_remote
+        #with speculation every task gets its own process group, so a cancelled copy can be killed with all its children
+        devnull=open(os.devnull, 'rb')
+        proc=subprocess.Popen(task.command, shell=True, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+            preexec_fn=os.setsid if self.speculate else None)
+        output=TaskOutput(self.scr, host, task, scr_handle)
+
+        killed=False
+        try:
+            streams={proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+            while streams:
+                if copy['cancelled'] and not killed:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    killed=True
+
+                readable, _, _ = select.select(list(streams.keys()), [], [], 1.0)
+                for fd in readable:
+                    data=os.read(fd, RECV_SIZE)
+                    if data:
+                        output.process(streams[fd], data)
+                    else:
+                        #end of file, the stream was closed
+                        del streams[fd]
+
+            return proc.wait(), output.stderr()
+        finally:
+            #do not leave processes behind if we fail while draining their output
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            devnull.close()
+            proc.stdout.close()
+            proc.stderr.close()
+            output.close()
 
     def __enter__(self):
         self.__start_workers()
@@ -223,8 +823,12 @@ class ServerQueue(object):
         self.active=False
 
         #close all connections
-        for client in self.clients:
-            client.close()
+        for host in self.hosts:
+            host.close()
+
+        #final state of the metrics
+        if self.metrics.prefix:
+            self.metrics.write()
 
         #stop the command screen gracefully
         self.scr.stop()
@@ -232,18 +836,26 @@ class ServerQueue(object):
 
     def join(self):
         #Regular Queue.join can not be interrupted
-        #We use this trick to allow Keyboard interrupt for example
+        #We wait with a timeout, which still returns as soon as the last task is done, to allow Keyboard interrupt for example
+        with self.pending_tasks_lock:
+            while self.pending_tasks!=0:
+                self.pending_tasks_lock.wait(1.0)
+
+    def as_completed(self):
+        #yield tasks as soon as they finish, until all tasks put so far are processed
         while True:
-            with self.pending_tasks_lock:
-                if self.pending_tasks==0:
-                    return
-            sleep(1)
+            try:
+                yield self.completed.get(timeout=1.0)
+            except Empty:
+                with self.pending_tasks_lock:
+                    if self.pending_tasks==0 and self.completed.empty():
+                        return
 
     def wait_user_exit(self, msg):
         #go ahead and already close the connections
         self.active=False
-        for client in self.clients:
-            client.close()
+        for host in self.hosts:
+            host.close()
 
         #wait for user to terminate the command screen
         self.info(msg)
@@ -252,15 +864,37 @@ class ServerQueue(object):
         while self.scr.isAlive():
             sleep(1)
 
+    def record(self, event, task, **fields):
+        if self.journal:
+            self.journal.record(event, task.command, **fields)
+
     #Override put and task done to do own administration of pending tasks
-    def put(self, item):
+    def put(self, item, inputs=[], outputs=[]):
+        #plain commands are wrapped in a task, requeued tasks keep their id and log
+        new=not isinstance(item, Task)
         with self.pending_tasks_lock:
             self.pending_tasks+=1
+            if new:
+                self.task_cnt+=1
+                log = os.path.join(self.log_dir, 'task_%d.log'%(self.task_cnt)) if self.log_dir else None
+                item=Task(item, self.task_cnt, log=log, inputs=inputs, outputs=outputs)
+
+        #the journal writes to disk, which should not hold up workers that finish tasks
+        if new:
+            self.record('queued', item)
         self.Q.put(item)
+        return item
+
+    def finish(self, task):
+        #final result of a task is known, it will not be requeued
+        task.finish()
+        self.metrics.record_completed(task)
+        self.completed.put(task)
 
     def task_done(self):
         with self.pending_tasks_lock:
             self.pending_tasks-=1
+            self.pending_tasks_lock.notify_all()
 
 
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+from threading import Lock, current_thread
+import posixpath
+import tempfile
+import stat
+import os
+
+from digest import cached_file_digest, atomic_open
+
+class Stager(object):
+    #copies the declared inputs of tasks to hosts without a shared file system, and their declared outputs back
+    #
+    #inputs are uploaded once per host into a content addressed directory, named after their digest:
+    #   <stage_dir>/<digest>
+    #and are linked from the same absolute path as on this machine, so commands run unmodified
+    #files with the same content are uploaded once, no matter how many tasks or paths use them
+
+    def __init__(self, stage_dir='.cache/cnn-demo/stage'):
+        self.stage_dir=stage_dir
+        self.lock=Lock()
+
+        #digests of local files by path, valid as long as mtime and size do not change
+        self.digests={}
+
+        #digests known to be present on each host
+        self.staged={}
+
+        #hosts found to share their file system with this machine
+        self.shared=set()
+
+        #per (host, directory): true if the host sees the directory of this machine, false if it has its own copy
+        self.probed={}
+
+    def isolated(self, host, paths):
+        #true only if the host is known to have its own copy of the directories of all paths
+        #directories that were not probed yet count as shared
+        dirs=set( os.path.dirname(os.path.abspath(path)) for path in paths )
+        with self.lock:
+            return host.host not in self.shared and all( self.probed.get((host.host, d)) is False for d in dirs )
+
+    def probe(self, client, host, paths):
+        #find out whether the host shares the directories of paths with this machine:
+        #a marker file is created here and looked up on the host
+        with self.lock:
+            dirs=sorted(set( os.path.dirname(os.path.abspath(path)) for path in paths if (host.host, os.path.dirname(os.path.abspath(path))) not in self.probed ))
+        if not dirs:
+            return
+
+        sftp=client.open_sftp()
+        try:
+            for d in dirs:
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                fd, marker = tempfile.mkstemp(prefix='.stage-probe-', dir=d)
+                os.close(fd)
+                try:
+                    #listing the directory avoids a negative lookup cached by a network file system on the host
+                    try:
+                        shared=os.path.basename(marker) in sftp.listdir(d)
+                    except IOError:
+                        shared=False
+                finally:
+                    os.remove(marker)
+                with self.lock:
+                    self.probed[(host.host, d)]=shared
+                    if shared:
+                        self.shared.add(host.host)
+        finally:
+            sftp.close()
+
+    def makedirs(self, sftp, path):
+        missing=[]
+        while path not in ['', '/']:
+            try:
+                sftp.stat(path)
+                break
+            except IOError:
+                missing.append(path)
+                path=posixpath.dirname(path)
+        for path in reversed(missing):
+            try:
+                sftp.mkdir(path)
+            except IOError:
+                #created by another slot in the meantime
+                pass
+
+    def push(self, client, host, paths):
+        #make the files in paths available on the host, returns the number of bytes uploaded
+        uploaded=0
+        sftp=client.open_sftp()
+        try:
+            stage_dir=sftp.normalize('.')+'/'+self.stage_dir if not self.stage_dir.startswith('/') else self.stage_dir
+            self.makedirs(sftp, stage_dir)
+            with self.lock:
+                staged=self.staged.setdefault(host.host, set())
+
+            for path in paths:
+                path=os.path.abspath(path)
+                if not os.path.exists(path):
+                    host.sq.warning('Declared input %s does not exist, not staging it on %s'%(path, host.host))
+                    continue
+                st=os.stat(path)
+
+                #a file system shared with the host already has the file
+                try:
+                    remote=sftp.lstat(path)
+                    if not stat.S_ISLNK(remote.st_mode) and remote.st_size==st.st_size and int(remote.st_mtime)==int(st.st_mtime):
+                        with self.lock:
+                            self.shared.add(host.host)
+                        continue
+                except IOError:
+                    remote=None
+
+                digest=cached_file_digest(path, self.digests)[0]
+                obj=stage_dir+'/'+digest
+                if digest not in staged:
+                    try:
+                        sftp.stat(obj)
+                    except IOError:
+                        #upload next to the object and move it in place in one step, other slots may stage the same file
+                        tmp='%s.%s.tmp'%(obj, current_thread().ident)
+                        sftp.put(path, tmp)
+                        sftp.posix_rename(tmp, obj)
+                        uploaded+=st.st_size
+                    with self.lock:
+                        staged.add(digest)
+
+                #make compares timestamps, so the object gets the oldest modification time of all files with its content
+                if int(sftp.stat(obj).st_mtime)>int(st.st_mtime):
+                    sftp.utime(obj, (st.st_atime, st.st_mtime))
+
+                #link the object from the original path, only links to staged objects are ever replaced
+                if remote is not None:
+                    target=sftp.readlink(path) if stat.S_ISLNK(remote.st_mode) else None
+                    if target==obj:
+                        continue
+                    if target is None or not target.startswith(stage_dir+'/'):
+                        raise IOError('%s exists on %s and is not a staged file, not replacing it'%(path, host.host))
+                    sftp.remove(path)
+                self.makedirs(sftp, posixpath.dirname(path))
+                sftp.symlink(obj, path)
+        finally:
+            sftp.close()
+        return uploaded
+
+    def pull(self, client, host, paths):
+        #copy the files in paths from the host, returns the number of bytes downloaded
+        downloaded=0
+        sftp=client.open_sftp()
+        try:
+            for path in paths:
+                path=os.path.abspath(path)
+                try:
+                    remote=sftp.stat(path)
+                except IOError:
+                    host.sq.warning('Declared output %s does not exist on %s'%(path, host.host))
+                    continue
+
+                #a file system shared with the host already has the file
+                if os.path.exists(path):
+                    st=os.stat(path)
+                    if st.st_size==remote.st_size and int(st.st_mtime)==int(remote.st_mtime):
+                        with self.lock:
+                            self.shared.add(host.host)
+                        continue
+
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with atomic_open(path, 'wb') as f:
+                    sftp.getfo(path, f)
+                    f.flush()
+                    os.utime(f.name, (remote.st_atime, remote.st_mtime))
+                downloaded+=remote.st_size
+        finally:
+            sftp.close()
+        return downloaded
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+from threading import Thread, Condition
+try:
+    #python3
+    from queue import Queue
+except:
+    #python 2
+    from Queue import Queue
+import numpy as np
+import struct
+import gzip
+import json
+import os
+
+#offsets of blobs in binary dumps are aligned to cache lines
+ALIGNMENT=64
+
+def san(s):
+    return s.replace('/','_')
+
+def align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+def write_text(fname, data):
+    #legacy format: one "%f" value per line of the first image in the batch
+    with open(fname, 'wt') as f:
+        np.savetxt(f, data[0].reshape(-1), fmt='%f')
+
+def write_binary(fname, blobs, manifest=None):
+    #write all (name, array) pairs as one contiguous file with aligned offsets
+    #the manifest describes where each blob lives so the dump can be memory-mapped later
+    manifest = manifest or os.path.splitext(fname)[0]+'.json'
+    entries=[]
+    with open(fname, 'wb') as f:
+        for name, data in blobs:
+            data = np.ascontiguousarray(data)
+            offset = align(f.tell())
+            f.seek(offset)
+            data.tofile(f)
+            entries.append({
+                "name": name,
+                "shape": list(data.shape),
+                "dtype": data.dtype.str,
+                "offset": offset,
+                "nbytes": data.nbytes,
+            })
+
+    with open(manifest, 'wt') as f:
+        json.dump({"file": os.path.basename(fname), "blobs": entries}, f, sort_keys=True, indent=4)
+
+    return manifest
+
+def load_binary(manifest):
+    #returns an ordered list of (name, memmap) pairs, nothing is read until the data is accessed
+    with open(manifest, 'rt') as f:
+        desc = json.load(f)
+    fname = os.path.join(os.path.dirname(manifest), desc['file'])
+    return [
+        (e['name'], np.memmap(fname, dtype=np.dtype(str(e['dtype'])), mode='r', offset=e['offset'], shape=tuple(e['shape'])))
+        for e in desc['blobs']
+    ]
+
+#packed weight container:
+#   8 bytes   magic
+#   8 bytes   little endian length of the json index
+#   8 bytes   little endian offset of the data section
+#   json index with layer, kind, shape, dtype, offset (relative to the data section) and nbytes of each tensor
+#   data section, every tensor aligned to ALIGNMENT bytes
+PACK_MAGIC=b'CNNWPK01'
+PACK_DTYPES=['float32', 'float16', 'int8']
+
+def quantization_scale(data, dtype):
+    #int8 uses symmetric per tensor quantization, other types are stored as is
+    if dtype == 'int8':
+        return float(np.abs(data).max())/127.0 or 1.0
+    return 1.0
+
+def quantize(data, dtype, scale):
+    if dtype == 'int8':
+        return np.clip(np.round(data/scale), -127, 127).astype(np.int8)
+    return data.astype(np.dtype(dtype))
+
+def create_packed(fname, tensors, dtype='float32'):
+    #write the header of a packed container and size the file for all tensors
+    #the index is computed up front so tensors can be converted one at a time and written in any order
+    #returns the index and the offset of the data section
+    index=[]
+    offset=0
+    for layer, kind, data in tensors:
+        offset = align(offset)
+        nbytes = data.size*np.dtype(dtype).itemsize
+        index.append({
+            "layer": layer,
+            "kind": kind,
+            "shape": list(data.shape),
+            "dtype": np.dtype(dtype).str,
+            "scale": quantization_scale(data, dtype),
+            "offset": offset,
+            "nbytes": nbytes,
+        })
+        offset += nbytes
+
+    header = json.dumps({"alignment": ALIGNMENT, "tensors": index}, sort_keys=True).encode('utf-8')
+    data_offset = align(len(PACK_MAGIC) + 16 + len(header))
+
+    with open(fname, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(struct.pack('<QQ', len(header), data_offset))
+        f.write(header)
+        f.truncate(data_offset + offset)
+
+    return index, data_offset
+
+def write_packed_tensor(fname, offset, data, dtype, scale):
+    with open(fname, 'r+b') as f:
+        f.seek(offset)
+        quantize(np.ascontiguousarray(data), dtype, scale).tofile(f)
+
+def write_packed(fname, tensors, dtype='float32'):
+    #tensors is a list of (layer, kind, array) tuples
+    index, data_offset = create_packed(fname, tensors, dtype=dtype)
+    for entry, (layer, kind, data) in zip(index, tensors):
+        write_packed_tensor(fname, data_offset+entry['offset'], data, dtype, entry['scale'])
+    return index
+
+def load_packed(fname):
+    #returns the index of a packed container, each entry extended with a memory-mapped 'data' array
+    with open(fname, 'rb') as f:
+        if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            raise ValueError("%s is not a packed weight file"%(fname))
+        header_len, data_offset = struct.unpack('<QQ', f.read(16))
+        index = json.loads(f.read(header_len).decode('utf-8'))['tensors']
+
+    for entry in index:
+        entry['data'] = np.memmap(fname, dtype=np.dtype(str(entry['dtype'])), mode='r', offset=data_offset+entry['offset'], shape=tuple(entry['shape']))
+    return index
+
+class BlobWriter(object):
+    #writes dumps in background threads so the caller can continue while blobs are written
+    #every blob is copied once when submitted, the total size of copies waiting to be written is bounded by max_bytes
+
+    def __init__(self, workers=4, max_bytes=1<<30, compress=False):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.pending_bytes = 0
+        self.cond = Condition()
+        self.errors = []
+
+        self.Q = Queue()
+        self.workers = [ Thread(target=self.__worker) for _ in range(workers) ]
+        for w in self.workers:
+            w.setDaemon(True)
+            w.start()
+
+    def __worker(self):
+        while True:
+            job = self.Q.get()
+            if job is None:
+                return
+            write, data = job
+            try:
+                write(data)
+            except Exception as e:
+                with self.cond:
+                    self.errors.append(e)
+            finally:
+                with self.cond:
+                    self.pending_bytes -= data.nbytes
+                    self.cond.notify_all()
+
+    def __submit(self, write, data):
+        #block while too much data is waiting, but always accept a blob when nothing is pending
+        with self.cond:
+            while self.pending_bytes > 0 and self.pending_bytes + data.nbytes > self.max_bytes:
+                self.cond.wait()
+            self.pending_bytes += data.nbytes
+        self.Q.put((write, np.array(data, copy=True)))
+
+    def write_text(self, fname, data):
+        if self.compress:
+            def write(data):
+                with gzip.open(fname+'.gz', 'wb') as f:
+                    np.savetxt(f, data[0].reshape(-1), fmt='%f')
+        else:
+            write = lambda data: write_text(fname, data)
+        self.__submit(write, data)
+
+    def write_raw(self, fname, data):
+        def write(data):
+            with open(fname, 'wb') as f:
+                data.tofile(f)
+        self.__submit(write, data)
+
+    def write_binary(self, fname, blobs, manifest=None):
+        #same format as write_binary, offsets are planned up front so all blobs can be written concurrently
+        manifest = manifest or os.path.splitext(fname)[0]+'.json'
+        entries=[]
+        offset=0
+        for name, data in blobs:
+            offset = align(offset)
+            entries.append({
+                "name": name,
+                "shape": list(data.shape),
+                "dtype": data.dtype.str,
+                "offset": offset,
+                "nbytes": data.nbytes,
+            })
+            offset += data.nbytes
+
+        with open(fname, 'wb') as f:
+            f.truncate(offset)
+        with open(manifest, 'wt') as f:
+            json.dump({"file": os.path.basename(fname), "blobs": entries}, f, sort_keys=True, indent=4)
+
+        for entry, (name, data) in zip(entries, blobs):
+            def write(data, offset=entry['offset']):
+                with open(fname, 'r+b') as f:
+                    f.seek(offset)
+                    np.ascontiguousarray(data).tofile(f)
+            self.__submit(write, data)
+
+        return manifest
+
+    def write_packed(self, fname, tensors, dtype='float32'):
+        #same format as write_packed, every tensor is converted and written by a worker
+        index, data_offset = create_packed(fname, tensors, dtype=dtype)
+        for entry, (layer, kind, data) in zip(index, tensors):
+            def write(data, offset=data_offset+entry['offset'], scale=entry['scale']):
+                write_packed_tensor(fname, offset, data, dtype, scale)
+            self.__submit(write, data)
+        return index
+
+    def close(self):
+        #wait for all writes and report the first error
+        for _ in self.workers:
+            self.Q.put(None)
+        for w in self.workers:
+            w.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
+from multiprocessing import Pool, cpu_count
 import csv
 import json
+import os
 import re
 
+from digest import write_atomic
+
+#measurement files written for the points of the DSE, see the %_remote.cmd target
+POINT_FILE_RE=re.compile(r'^(?P<kind>accesses|memsize)_(?P<idx>\d+)\.csv$')
+
 def extract_csv(fname, idx=0):
     with open(fname, 'rt') as csvfile:
         return dict( (name, int(size)) for name, size in  csv.reader(csvfile, delimiter=',', quotechar='"'))
@@ -32,7 +39,89 @@ def extract_bsize(fname, ignore=['maximum', 'sum']):
     #return maximum buffer size
     return max(table.values())
 
-def extract_point(facc, fbsize):
+def point_index(fname):
+    m=POINT_FILE_RE.match(os.path.basename(fname))
+    return int(m.group('idx')) if m else None
+
+def pair_files(facc, fbsize):
+    #pair accesses and memsize files by the index in their name, shell globs sort accesses_10 before accesses_2
+    #returns (idx, accesses file, memsize file) for every point with both files, points that miss a file are skipped
+    #files that do not follow the naming scheme are paired in the given order and numbered by their position
+    acc=dict( (point_index(f), f) for f in facc )
+    bsize=dict( (point_index(f), f) for f in fbsize )
+    if None in acc or None in bsize:
+        return [ (idx, a, b) for idx, (a, b) in enumerate(zip(facc, fbsize)) ]
+
+    pairs=[]
+    for idx in sorted(set(acc.keys()+bsize.keys())):
+        if idx in acc and idx in bsize:
+            pairs.append((idx, acc[idx], bsize[idx]))
+        else:
+            missing=[ name for name, files in [('accesses', acc), ('memsize', bsize)] if idx not in files ]
+            print "WARNING: point %d has no %s file, skipping it"%(idx, ' or '.join(missing))
+    return pairs
+
+EXTRACT={'accesses': extract_accesses, 'bsize': extract_bsize}
+
+def _extract(job):
+    kind, fname = job
+    return EXTRACT[kind](fname)
+
+def load_cache(fname):
+    try:
+        with open(fname, 'rt') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache(fname, cache):
+    write_atomic(fname, json.dumps(cache, sort_keys=True))
+
+def extract_files(jobs, cache=None, workers=None):
+    #returns the extracted value of every (kind, fname) job
+    #values of files that did not change since they were cached, by path, mtime and size, are not extracted again
+    #the cache is updated in place with the values of all jobs
+    if cache is None:
+        cache={}
+
+    def key(job):
+        kind, fname = job
+        st=os.stat(fname)
+        return os.path.abspath(fname), {"kind": kind, "mtime": st.st_mtime, "size": st.st_size}
+
+    values={}
+    todo=[]
+    for job in jobs:
+        path, stamp = key(job)
+        entry=cache.get(path)
+        if entry and all(entry.get(k)==v for k, v in stamp.items()):
+            values[job]=entry['value']
+        else:
+            todo.append(job)
+
+    if todo:
+        workers=workers or cpu_count()
+        if workers>1 and len(todo)>1:
+            pool=Pool(min(workers, len(todo)))
+            try:
+                extracted=pool.map(_extract, todo, chunksize=max(1, len(todo)//(4*workers)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            extracted=map(_extract, todo)
+
+        for job, value in zip(todo, extracted):
+            values[job]=value
+            path, stamp = key(job)
+            cache[path]=dict(stamp, value=value)
+
+    return values
+
+def extract_point(facc, fbsize, values=None):
 
     # Sanity check in case files match the typical usecase in this project
     a=re.match('accesses_(?P<idx>\d+).csv', facc)
@@ -40,10 +129,12 @@ def extract_point(facc, fbsize):
     if a and b and a.groupdict()['idx'] != b.groupdict()['idx']:
         print "WARNING: indexes of %s and %s don't seem to match. Continuing but results may be wrong...."%(facc,fbsize)
 
+    #values holds already extracted results, see extract_files
+    values=values or {}
     return {
         "networkcost": {
-            "accesses": extract_accesses(facc),
-            "buffer_size": extract_bsize(fbsize),
+            "accesses": values[('accesses', facc)] if ('accesses', facc) in values else extract_accesses(facc),
+            "buffer_size": values[('bsize', fbsize)] if ('bsize', fbsize) in values else extract_bsize(fbsize),
             "macs": 0
         }
     }
@@ -67,11 +158,26 @@ if __name__ == '__main__':
         help="Output filename"
     )
 
+    parser.add_argument('-c', '--cache', dest='cache', required=False, action='store', default=None,
+        help="File to cache the results of each csv file in, only new or changed files are parsed again"
+    )
+
+    parser.add_argument('-j', '--workers', dest='workers', required=False, action='store', default=None, type=int,
+        help="Number of processes that parse csv files in parallel. Defaults to the number of cores"
+    )
+
     # Parse arguments
     args = parser.parse_args()
 
     #extract the results
-    results=[ extract_point(a,b) for a,b in zip(args.facc, args.fbsize)]
+    pairs=pair_files(args.facc, args.fbsize)
+    cache=load_cache(args.cache) if args.cache else {}
+    values=extract_files([ ('accesses', facc) for idx, facc, fbsize in pairs ]+[ ('bsize', fbsize) for idx, facc, fbsize in pairs ], cache=cache, workers=args.workers)
+    if args.cache:
+        save_cache(args.cache, cache)
+
+    #every point records the index of the point of the DSE it measures, since points with missing files are skipped
+    results=[ dict(extract_point(facc, fbsize, values), index=idx) for idx, facc, fbsize in pairs ]
 
     #store to json
     with open(args.fout, 'wt') as f:
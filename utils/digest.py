@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+from contextlib import contextmanager
+from threading import current_thread
+import hashlib
+import json
+import os
+
+def file_digest(fname, blocksize=1<<20):
+    #hash of the content of a file, read in blocks to keep memory bounded for large caffemodels
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def cached_file_digest(fname, digests):
+    #file_digest remembered in the dictionary digests by absolute path, valid as long as mtime and size do not change
+    #returns the digest and whether it had to be computed
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    known = digests.get(path)
+    if known and known['mtime'] == st.st_mtime and known['size'] == st.st_size:
+        return known['digest'], False
+
+    digest = file_digest(path)
+    digests[path] = {"mtime": st.st_mtime, "size": st.st_size, "digest": digest}
+    return digest, True
+
+def settings_digest(settings):
+    #hash of any json serializable object, independent of the order of dictionary keys
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+def combine(*digests):
+    return hashlib.sha1(':'.join(digests).encode('utf-8')).hexdigest()
+
+@contextmanager
+def atomic_open(fname, mode='wt'):
+    #write to a temporary file next to fname and move it in place when done
+    #readers, concurrent writers and later runs never see a partially written file
+    tmp = '%s.%d.%d.tmp'%(fname, os.getpid(), current_thread().ident)
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.rename(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_atomic(fname, text):
+    with atomic_open(fname) as f:
+        f.write(text)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import sys
 from ServerQueue import ServerQueue
+from RuntimeHistory import RuntimeHistory
+from Journal import Journal, parse_command, up_to_date
+from Stager import Stager
 import logging
+import multiprocessing
 import argparse
 import os
 import pwd
@@ -39,13 +43,73 @@ parser.add_argument('-c', '--cmd', dest='cmd', required=False, action='store', d
 )
 
 parser.add_argument('-s', '--servers', dest='server_conf', required=False, action='store', default=None,
-    help="Path to config file with servers to use. When not specified localhost with the current username will be used"
+    help="Path to config file with servers to use. When not specified all commands run on the local machine, one per core"
 )
 
 parser.add_argument('-n', '--no-wait', dest='nowait', required=False, action='store_true', default=False,
     help="Do not wait for user input to terminate after all jobs are processed"
 )
 
+parser.add_argument('-l', '--log-dir', dest='log_dir', required=False, action='store', default=None,
+    help="Directory to store the full output of every task. Defaults to <cmd>.logs next to the command file"
+)
+
+parser.add_argument('--history', dest='history', required=False, action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtimes.json'),
+    help="File with runtimes of previous runs, used to start the longest commands first"
+)
+
+parser.add_argument('--keep-order', dest='keep_order', required=False, action='store_true', default=False,
+    help="Issue commands in the order of the command file instead of longest first"
+)
+
+parser.add_argument('--probe-interval', dest='probe_interval', required=False, action='store', default=30, type=int,
+    help="Seconds between load probes of hosts with 'adaptive = yes' in the server config"
+)
+
+parser.add_argument('--no-resume', dest='resume', required=False, action='store_false', default=True,
+    help="Ignore the journal of a previous run and execute all commands again"
+)
+
+parser.add_argument('--no-skip-up-to-date', dest='skip_up_to_date', required=False, action='store_false', default=True,
+    help="Also execute commands whose declared outputs exist and are newer than their declared inputs"
+)
+
+parser.add_argument('--max-retries', dest='max_retries', required=False, action='store', default=3, type=int,
+    help="Number of times a failing command is retried before it is quarantined"
+)
+
+parser.add_argument('--quarantine-hosts', dest='quarantine_hosts', required=False, action='store', default=2, type=int,
+    help="Quarantine a failing command as soon as it failed on this many different servers"
+)
+
+parser.add_argument('--speculate', dest='speculate', required=False, action='store_true', default=False,
+    help="Once all commands are started, run a copy of commands that take longer than expected on idle servers. The first copy to finish wins. Requires --stage, copies only run on remote servers without a shared file system"
+)
+
+parser.add_argument('--speculate-factor', dest='speculate_factor', required=False, action='store', default=1.5, type=float,
+    help="Start a copy of a command when it runs this many times longer than its expected runtime"
+)
+
+parser.add_argument('--stage', dest='stage', required=False, action='store_true', default=False,
+    help="Copy the declared inputs of commands to remote servers over sftp and their declared outputs back, for servers without a shared file system"
+)
+
+parser.add_argument('--stage-dir', dest='stage_dir', required=False, action='store', default='.cache/cnn-demo/stage',
+    help="Directory on remote servers, relative to the home directory, that caches staged files by content"
+)
+
+parser.add_argument('--headless', dest='headless', required=False, action='store_true', default=not sys.stdout.isatty(),
+    help="Print plain log lines instead of the interactive screen. Default when the output is not a terminal"
+)
+
+parser.add_argument('--metrics', dest='metrics', required=False, action='store', default=None,
+    help="Periodically write metrics of the run to METRICS.json and METRICS.prom (prometheus text format)"
+)
+
+parser.add_argument('--metrics-interval', dest='metrics_interval', required=False, action='store', default=10, type=int,
+    help="Seconds between updates of the metrics files"
+)
+
 parser.add_argument('-p', '--not-persistent', dest='persistent', required=False, action='store_false', default=True,
     help="Skip failed jobs"
 )
@@ -53,27 +117,67 @@ parser.add_argument('-p', '--not-persistent', dest='persistent', required=False,
 # Parse arguments
 args = parser.parse_args()
 
+#copies of a command on a shared file system would write the same output files at the same time
+if args.speculate and not args.stage:
+    parser.error("--speculate requires --stage, so copies of a command write their outputs on separate servers")
+
 #Construct the logger
 logging.basicConfig(level=args.log_level, format="%(message)s")
 logger = logging.getLogger()
 
-#Get servers to use, default is localhost with current username
+#Get servers to use, default is the local machine with one slot per core
 if not args.server_conf:
-    servers=[( 'localhost', get_username())]
+    servers=[( 'localhost', get_username(), {'local': True})]*multiprocessing.cpu_count()
 else:
     cp=ConfigParser()
     cp.read(args.server_conf)
     servers=[]
     for sec in cp.sections():
-        if 'connections' not in cp.options(sec):
-            servers+=[(cp.get(sec, 'host'), cp.get(sec, 'user'))]
+        #tasks of local servers run as subprocesses of the driver instead of over ssh
+        local=cp.has_option(sec, 'local') and cp.getboolean(sec, 'local')
+        host=cp.get(sec, 'host') if cp.has_option(sec, 'host') else 'localhost'
+        user=cp.get(sec, 'user') if cp.has_option(sec, 'user') else get_username()
+        options={'local': True} if local else {}
+
+        if cp.has_option(sec, 'adaptive') and cp.getboolean(sec, 'adaptive'):
+            #adaptive hosts resize their number of slots between min_connections and max_connections depending on their load
+            if cp.has_option(sec, 'max_connections'):
+                max_slots=cp.getint(sec, 'max_connections')
+            elif cp.has_option(sec, 'connections'):
+                max_slots=cp.getint(sec, 'connections')
+            elif local:
+                max_slots=multiprocessing.cpu_count()
+            else:
+                parser.error("adaptive server %s in %s needs max_connections, the number of cores of a remote server is not known in advance"%(sec, args.server_conf))
+            options.update({
+                'adaptive': True,
+                'min_slots': cp.getint(sec, 'min_connections') if cp.has_option(sec, 'min_connections') else 1,
+                'max_slots': max_slots,
+            })
+            servers+=[(host, user, options)]
+        elif 'connections' not in cp.options(sec):
+            #local servers default to one slot per core
+            servers+=[(host, user, options)]*(multiprocessing.cpu_count() if local else 1)
         else:
             #if multiple connections are specified, we add N times to encourage concurrency
+            #ServerQueue runs these slots as channels over a shared ssh connection to the host
             for con_id in range(int(cp.get(sec,'connections'))):
-                servers+=[(cp.get(sec, 'host'), cp.get(sec, 'user'))]
+                servers+=[(host, user, options)]
+
+#full task output is spooled next to the command file unless specified otherwise
+log_dir = args.log_dir or (args.cmd+'.logs' if args.cmd else None)
+
+#runtimes of earlier runs
+history=RuntimeHistory(args.history)
+
+#progress of the command file is journaled next to it, so an interrupted run can resume
+journal = Journal(args.cmd+'.journal', args.cmd, resume=args.resume) if args.cmd else None
 
 #create ServerQueue
-with ServerQueue(servers, persistent=args.persistent) as SQ:
+with ServerQueue(servers, persistent=args.persistent, log_dir=log_dir, probe_interval=args.probe_interval, journal=journal, max_retries=args.max_retries, quarantine_hosts=args.quarantine_hosts,
+    headless=args.headless, metrics=args.metrics, metrics_interval=args.metrics_interval,
+    speculate=args.speculate, speculate_factor=args.speculate_factor, expected=history.runtime,
+    stager=Stager(args.stage_dir) if args.stage else None) as SQ:
 
     #Issue all the commands
     if not args.cmd:
@@ -83,14 +187,57 @@ with ServerQueue(servers, persistent=args.persistent) as SQ:
             SQ.put('hostname')
     else:
         with open(args.cmd, 'rt') as f:
-            for cmd in f.readlines():
-                #put command in the queue
-                SQ.put(cmd.strip('\n'))
+            cmds=[ parse_command(cmd.strip('\n')) for cmd in f.readlines() if cmd.strip() ]
+
+        #skip what a previous run completed, or what is up to date already
+        todo=[]
+        for cmd, inputs, outputs in cmds:
+            #a finished command still runs again when its declared inputs changed since
+            if journal.finished(cmd) and (not outputs or up_to_date(inputs, outputs)):
+                SQ.info("Skipping %s, completed by a previous run"%(cmd))
+            elif args.skip_up_to_date and up_to_date(inputs, outputs):
+                SQ.info("Skipping %s, outputs are up to date"%(cmd))
+            else:
+                todo.append((cmd, inputs, outputs))
+
+        #start the most expensive commands first, so they do not end up setting the makespan
+        if not args.keep_order:
+            declared=dict( (cmd, (inputs, outputs)) for cmd, inputs, outputs in todo )
+            todo=[ (cmd,)+declared[cmd] for cmd in history.order([ cmd for cmd, inputs, outputs in todo ]) ]
+
+        for cmd, inputs, outputs in todo:
+            #put command in the queue
+            SQ.put(cmd, inputs=inputs, outputs=outputs)
+
+    #Report results as soon as each task completes
+    failed=[]
+    for task in SQ.as_completed():
+        if task.success:
+            SQ.info("Task %d finished on %s in %.1f seconds"%(task.id, task.host, task.duration))
+            history.record(task.command, task.duration)
+            history.save()
+        else:
+            SQ.warning("Task %d failed on %s with exit status %d: %s"%(task.id, task.host, task.exit_status, task.command))
+            failed.append(task)
 
     #Wait for all commands to be processed
     logging.debug("Waiting for all tasks to be completed")
     SQ.join()
 
+    if failed:
+        SQ.warning("%d tasks failed, see the logs of tasks %s"%(len(failed), ', '.join(str(task.id) for task in failed)))
+
+    #tasks that kept failing, most likely due to the command itself
+    for task in SQ.quarantine:
+        SQ.warning("Quarantined task %d after %d attempts on %s: %s"%(task.id, len(task.attempts), ', '.join(sorted(task.failed_hosts())), task.command))
+
+    #summary of the run
+    for line in SQ.metrics.summary():
+        SQ.info(line)
+
+    if journal:
+        journal.close()
+
     #wait for user to terminate GUI
     if not args.nowait:
         SQ.wait_user_exit("All tasks completed! Press 'q' to exit")
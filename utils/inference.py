@@ -3,7 +3,201 @@ import caffe
 import numpy as np
 import argparse
 import logging
+import json
+import os
+import re
+import resource
+import ctypes
+import time
+from multiprocessing import Pool, cpu_count
+
+from blobdump import san, load_binary, PACK_DTYPES, BlobWriter
+from GoldenCache import GoldenCache
+from tiling import load_tiled_net, tiled_forward
+from Preprocessor import Preprocessor, transform_settings, build_transformer
+from stats import median
+
+
+def load_net(prototxt, caffemodel):
+    # Use CPU for verification
+    caffe.set_mode_cpu()
+
+    # load caffe network
+    return caffe.Net(
+        prototxt,
+        caffemodel,
+        caffe.TEST
+    )
 
+def create_transformer(net, scale=1.0):
+    return build_transformer(transform_settings(net.blobs['data'].data.shape, scale=scale))
+
+def output_blob(net):
+    #classification networks end in a 'prob' layer, others just use the last output of the network
+    return 'prob' if 'prob' in net.outputs else net.outputs[-1]
+
+#extensions of files that are picked up when a directory of images is passed
+IMAGE_EXTENSIONS=('.jpg', '.jpeg', '.png', '.bmp', '.ppm', '.pgm', '.tif', '.tiff')
+
+def list_images(path):
+    #a directory is searched for image files, anything else is treated as a file with one image path per line
+    if os.path.isdir(path):
+        return [ os.path.join(path, fname) for fname in sorted(os.listdir(path)) if os.path.splitext(fname)[1].lower() in IMAGE_EXTENSIONS ]
+
+    #relative paths in a list file are relative to the list file itself
+    root=os.path.dirname(path)
+    with open(path, 'rt') as f:
+        return [ os.path.join(root, line.strip()) for line in f.readlines() if line.strip() and not line.strip().startswith('#') ]
+
+def selected(lyr_name, layers):
+    #layers is a list of regular expressions, None selects all layers
+    return layers is None or any(re.match(pattern, lyr_name) for pattern in layers)
+
+def write_weights(net, logger, writer, layers=None):
+    for lyr_name, param in net.params.iteritems():
+        if not selected(lyr_name, layers):
+            continue
+
+        fname=san(lyr_name)+'_weights.bin'
+        logger.info("Writing weights of layer %s to file %s"%(lyr_name, fname))
+        logger.debug("%s weights %s"%(lyr_name, str(param[0].data.shape)))
+        writer.write_raw(fname, param[0].data)
+
+        fname=san(lyr_name)+'_bias.bin'
+        logger.info("Writing bias of layer %s to file %s"%(lyr_name, fname))
+        logger.debug("%s bias %s"%(lyr_name, str(param[1].data.shape)))
+        writer.write_raw(fname, param[1].data)
+
+def param_kind(idx):
+    return ['weights', 'bias'][idx] if idx < 2 else 'param%d'%(idx)
+
+def write_packed_weights(net, logger, writer, fname='weights.pack', dtype='float32', layers=None):
+    #all parameters of all layers in one aligned file with an index header
+    tensors=[ (lyr_name, param_kind(idx), p.data) for lyr_name, param in net.params.iteritems() if selected(lyr_name, layers) for idx, p in enumerate(param) ]
+    logger.info("Writing %d %s tensors of %d layers to file %s"%(len(tensors), dtype, len(net.params), fname))
+    writer.write_packed(fname, tensors, dtype=dtype)
+
+def write_buffers(net, logger, writer, fmt='binary', fname='buffers.bin', layers=None):
+    blobs = [ (lyr_name, blob.data) for lyr_name, blob in net.blobs.iteritems() if selected(lyr_name, layers) ]
+    if fmt == 'text':
+        #one text file per layer for compatibility with existing *_buf.txt consumers
+        for lyr_name, data in blobs:
+            txt_name=san(lyr_name)+'_buf.txt'
+            logger.info("Dumping buffer of layer %s to file %s"%(lyr_name, txt_name))
+            writer.write_text(txt_name, data)
+    else:
+        logger.info("Dumping buffers of %d layers to file %s"%(len(blobs), fname))
+        manifest=writer.write_binary(fname, blobs)
+        logger.info("Wrote buffer manifest to %s"%(manifest))
+
+def restore_buffers(manifest, logger, writer, fmt='binary', fname='buffers.bin', layers=None):
+    #reproduce the output of write_buffers from a binary dump stored elsewhere
+    blobs = [ (lyr_name, data) for lyr_name, data in load_binary(manifest) if selected(lyr_name, layers) ]
+    if fmt == 'text':
+        for lyr_name, data in blobs:
+            txt_name=san(lyr_name)+'_buf.txt'
+            logger.info("Restoring buffer of layer %s to file %s"%(lyr_name, txt_name))
+            writer.write_text(txt_name, data)
+    else:
+        logger.info("Restoring buffers of %d layers to file %s"%(len(blobs), fname))
+        writer.write_binary(fname, blobs)
+
+def percentile(values, p):
+    #linear interpolation between the closest ranks
+    values = sorted(values)
+    pos = (len(values)-1)*p/100.0
+    low = int(pos)
+    high = min(low+1, len(values)-1)
+    return values[low] + (values[high]-values[low])*(pos-low)
+
+def summarize(values):
+    return {
+        "mean": sum(values)/len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+def current_rss():
+    #resident set size in bytes from /proc, zero on systems without it
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1])*resource.getpagesize()
+    except IOError:
+        return 0
+
+def reset_peak_rss():
+    #reset the high-water mark of the resident set size of this process, returns False if the kernel does not support it
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+def peak_rss():
+    #high-water mark of the resident set size in bytes since the last reset_peak_rss
+    with open('/proc/self/status', 'rt') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])*1024
+    return 0
+
+def profile_layers(net, logger, runs=5):
+    #step through the network one layer at a time and record cost and memory of each layer
+    layers = [
+        {
+            "name": name,
+            "type": layer.type,
+            "tops": list(net.top_names[name]),
+            "output_bytes": sum(net.blobs[top].data.nbytes for top in net.top_names[name]),
+            "param_bytes": sum(p.data.nbytes for p in net.params[name]) if name in net.params else 0,
+            "times": [],
+        }
+        for name, layer in zip(net._layer_names, net.layers)
+    ]
+
+    #the process high-water mark is reset before every layer, so the peak of each layer is measured on its own
+    #ru_maxrss is reported in kilobytes on linux, it includes the regular feedforward before profiling
+    process_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    per_layer_peak = reset_peak_rss()
+    if not per_layer_peak:
+        logger.warning("Can not reset the peak memory usage of this process, peak memory per layer is not available")
+
+    for run in xrange(runs):
+        logger.info("Profiling run %d of %d"%(run+1, runs))
+        for layer in layers:
+            rss = current_rss()
+            if per_layer_peak:
+                reset_peak_rss()
+
+            start = time.time()
+            net.forward(start=layer['name'], end=layer['name'])
+            layer['times'].append(time.time()-start)
+
+            #memory the layer needed on top of what was resident before it ran, the worst of all runs
+            if per_layer_peak:
+                peak = peak_rss()
+                process_peak = max(process_peak, peak)
+                layer['peak_rss_delta_bytes'] = max(layer.get('peak_rss_delta_bytes', 0), peak-rss)
+            else:
+                layer['peak_rss_delta_bytes'] = None
+            layer['rss_bytes'] = current_rss()
+
+    for layer in layers:
+        layer['time'] = median(layer['times'])
+        logger.debug("Layer %s took %f seconds"%(layer['name'], layer['time']))
+
+    return {
+        "runs": runs,
+        "time": sum(layer['time'] for layer in layers),
+        #in-place layers (e.g. ReLU) write to their input blob, every blob is counted once
+        "output_bytes": sum(net.blobs[top].data.nbytes for top in set(top for layer in layers for top in layer['tops'])),
+        "param_bytes": sum(layer['param_bytes'] for layer in layers),
+        #resetting the high-water mark also lowers ru_maxrss, so the peak is tracked over all layers
+        "peak_rss_bytes": max(process_peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024),
+        "layers": layers,
+    }
 
 def feed_fwd(
         prototxt,
@@ -12,58 +206,53 @@ def feed_fwd(
         logger,
         dump_buffers=False,
         dump_weights=False,
+        dump_format='binary',
+        weights_format='separate',
+        weights_dtype='float32',
         scale=1.0,
+        profile=None,
+        profile_runs=5,
+        cache=None,
+        tile=None,
+        tile_workers=1,
+        dump_layers=None,
+        dump_workers=4,
+        dump_compress=False,
     ):
 
-    def san(s):
-        return s.replace('/','_')
-
-    # Use CPU for verification
-    caffe.set_mode_cpu()
-
-    # load caffe network
-    net = caffe.Net(
-        prototxt,
-        caffemodel,
-        caffe.TEST
-    )
-
+    #reference outputs are cached by the content of all inputs, only runs that need the network itself bypass the cache
+    use_cache = cache is not None and not dump_weights and not profile
+    if use_cache:
+        key = cache.key(prototxt, caffemodel, image, transform_settings([], scale=scale))   # the input shape is covered by the prototxt
+        hit = cache.get(key, buffers=dump_buffers)
+        if hit:
+            output_prob, manifest = hit
+            logger.info("Found reference output of %s in cache"%(image))
+            if dump_buffers:
+                with BlobWriter(workers=dump_workers, compress=dump_compress) as writer:
+                    restore_buffers(manifest, logger, writer, fmt=dump_format, layers=dump_layers)
+            logger.info("Index of largest output is \"%s\", with value \"%s\""%(str(output_prob.argmax()), str(output_prob[output_prob.argmax()])))
+            return output_prob.argmax()
+
+    if tile:
+        #the network is only allocated at the size of one tile plus its halo, never at the size of the full image
+        net, plan = load_tiled_net(prototxt, caffemodel, tile, logger)
+        settings = transform_settings(plan['input_shape'], scale=scale)
+    else:
+        net = load_net(prototxt, caffemodel)
+        settings = transform_settings(net.blobs['data'].data.shape, scale=scale)
+
+    #dumps are written in the background while the network is running
+    writer = BlobWriter(workers=dump_workers, compress=dump_compress)
 
     #dump weights and biases
     if dump_weights:
-        for lyr_name, param in net.params.iteritems():
-
-            fname=san(lyr_name)+'_weights.bin'
-            with open(fname, 'wb') as f:
-                logger.info("Writing weights of layer %s to file %s"%(lyr_name, fname))
-                logger.debug(lyr_name, 'weights', param[0].data.shape)
-                f.write(param[0].data)
-
-            fname=san(lyr_name)+'_bias.bin'
-            with open(fname, 'wb') as f:
-                logger.info("Writing bias of layer %s to file %s"%(lyr_name, fname))
-                logger.debug(lyr_name, 'bias', param[1].data.shape)
-                f.write(param[1].data)
-
-
-    # Create transformer for the input called 'data'
-    transformer = caffe.io.Transformer({'data': net.blobs['data'].data.shape})
-    transformer.set_transpose('data', (2,0,1))                              # move image channels to outermost dimension
-    transformer.set_raw_scale('data', 255.0)                                # rescale from [0, 1] to [0, 255]
-    transformer.set_mean('data', np.array([103.939,116.779,123.68]))        # subtract the dataset-mean value in each channel (RGB)
-    transformer.set_channel_swap('data', (2,1,0))                           # swap channels from RGB to BGR
-    transformer.set_input_scale('data', scale)
-
-    def inference(fname):
-        image = caffe.io.load_image(fname)
-        transformed_image = transformer.preprocess('data', image)
-
-        net.blobs['data'].data[...] = transformed_image
-        output = net.forward()
-        output_prob = output['prob'][0] #output probability of first image in the batch
-
-        return output_prob.argmax()
+        if weights_format == 'packed':
+            write_packed_weights(net, logger, writer, dtype=weights_dtype, layers=dump_layers)
+        else:
+            write_weights(net, logger, writer, layers=dump_layers)
 
+    transformer = build_transformer(settings)
 
     logger.info("Loading image %s"%(image))
     image = caffe.io.load_image(image)
@@ -71,37 +260,324 @@ def feed_fwd(
     logger.info("Transforming input data by subtracting the dataset-mean for image net and scaling to [0-255]")
     transformed_image = transformer.preprocess('data', image)
 
-    #set transformed image as input to the network
-    net.blobs['data'].data[...] = transformed_image
+    if tile:
+        #the full image is never set as input, only the tiles are
+        logger.info("Start tiled feedforward")
+        output = tiled_forward(net, plan, transformed_image[np.newaxis], logger, workers=tile_workers)
+        logger.info("End of tiled feedforward")
+    else:
+        #set transformed image as input to the network
+        net.blobs['data'].data[...] = transformed_image
 
-    logger.info("Start feedforward")
-    output = net.forward()
-    logger.info("End of feedforward")
+        logger.info("Start feedforward")
+        output = net.forward()
+        logger.info("End of feedforward")
 
     if dump_buffers:
-        for lyr_name, blob in net.blobs.iteritems():
-            fname=san(lyr_name)+'_buf.txt'
-            logger.info("Dumping buffer of layer %s to file %s"%(lyr_name, fname))
-            with open(fname, 'wt') as f:
-                shape = tuple(blob.data.shape)
-                if len(shape)==2:
-                    batch, z = shape
-                    for o in xrange(z):
-                        f.write("%f\n"%(blob.data.item(0,o)))
-                else:
-                    batch, z, y, x = shape
-                    for o in xrange(z):
-                        for m in xrange(y):
-                            for n in xrange(x):
-                                f.write("%f\n"%(blob.data.item(0,o,m,n)))
+        write_buffers(net, logger, writer, fmt=dump_format, layers=dump_layers)
+
+    #the regular feedforward above doubles as warm-up for the profiling runs
+    if profile:
+        result = profile_layers(net, logger, runs=profile_runs)
+        logger.info("Writing profile of %d layers to %s"%(len(result['layers']), profile))
+        with open(profile, 'wt') as f:
+            json.dump(result, f, sort_keys=True, indent=4)
 
     #output probability of first image in the batch
-    output_prob = output['prob'][0]
+    output_prob = output[output_blob(net)][0]
+
+    if use_cache:
+        cache.put(key, output_prob, buffers=[ (lyr_name, blob.data) for lyr_name, blob in net.blobs.iteritems() ] if dump_buffers else None)
+
+    #wait for all dumps to be written
+    writer.close()
+
     logger.info("Index of largest output is \"%s\", with value \"%s\""%(str(output_prob.argmax()), str(output_prob[output_prob.argmax()])))
 
     #return index of max
     return output_prob.argmax()
 
+def forward_images(
+        net,
+        images,
+        logger,
+        batch_size=16,
+        scale=1.0,
+        preprocess_workers=0,
+        prefetch=64,
+        preprocess_cache=None,
+        first=0,
+        total=None,
+    ):
+    #forward all images in batches and return the outputs of every image in input order
+    #first and total are only used to report progress when images is a shard of a larger set
+    total = total or len(images)
+
+    #shape of a single image as expected by the network
+    data_shape = tuple(net.blobs['data'].data.shape[1:])
+    out_name = output_blob(net)
+
+    def forward(batch):
+        #resize the input for this batch, the last batch can be smaller than the others
+        if net.blobs['data'].data.shape[0] != len(batch):
+            logger.debug("Reshaping input data to batch size %d"%(len(batch)))
+            net.blobs['data'].reshape(len(batch), *data_shape)
+            net.reshape()
+
+        for idx, (fname, data) in enumerate(batch):
+            net.blobs['data'].data[idx] = data
+
+        logger.info("Feedforward of images %d to %d of %d"%(first+len(points), first+len(points)+len(batch)-1, total))
+        output = net.forward()
+
+        for idx, (fname, data) in enumerate(batch):
+            output_prob = output[out_name][idx].reshape(-1)
+            argmax = int(output_prob.argmax())
+            points.append({
+                "image": fname,
+                "argmax": argmax,
+                "value": float(output_prob[argmax]),
+                "probabilities": output_prob.tolist(),
+            })
+
+    #images are decoded and transformed ahead of the forward passes
+    points=[]
+    settings = transform_settings(net.blobs['data'].data.shape, scale=scale)
+    with Preprocessor(settings, workers=preprocess_workers, prefetch=prefetch, cache_dir=preprocess_cache) as pre:
+        batch=[]
+        for fname, data in pre.map(images):
+            batch.append((fname, data))
+            if len(batch) == batch_size:
+                forward(batch)
+                batch=[]
+        if batch:
+            forward(batch)
+
+    return points
+
+#libraries caffe may be linked against and the call to change their number of threads at runtime
+BLAS_THREAD_FUNCTIONS=[
+    ('libopenblas', 'openblas_set_num_threads'),
+    ('libmkl_rt', 'MKL_Set_Num_Threads'),
+    ('libgomp', 'omp_set_num_threads'),
+    ('libiomp5', 'omp_set_num_threads'),
+]
+
+def set_blas_threads(n, logger):
+    #environment variables only affect libraries that are not initialized yet
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var]=str(n)
+
+    #libraries that are already loaded by caffe have to be told through their own api
+    try:
+        with open('/proc/self/maps', 'rt') as f:
+            libs = set(line.split()[-1] for line in f if '.so' in line)
+    except IOError:
+        libs = set()
+
+    for lib in libs:
+        for prefix, func in BLAS_THREAD_FUNCTIONS:
+            if os.path.basename(lib).startswith(prefix):
+                try:
+                    getattr(ctypes.CDLL(lib), func)(n)
+                    logger.debug("Set %d threads with %s of %s"%(n, func, lib))
+                except (OSError, AttributeError):
+                    pass
+
+#state shared with forked workers, the network is loaded by the parent before the pool is created
+#so all workers share the read-only weights copy-on-write instead of loading their own copy
+_shared = {}
+
+def _init_forward_worker(blas_threads):
+    if blas_threads:
+        set_blas_threads(blas_threads, _shared['logger'])
+
+def _forward_shard(shard):
+    first, images = shard
+    return forward_images(_shared['net'], images, _shared['logger'], first=first, **_shared['kwargs'])
+
+def forward_images_parallel(net, images, logger, workers, blas_threads=None, batch_size=16, **kwargs):
+    #shard the images over worker processes, one batch per shard to balance the load
+    _shared['net'] = net
+    _shared['logger'] = logger
+    _shared['kwargs'] = dict(kwargs, batch_size=batch_size, total=len(images))
+
+    logger.info("Starting %d workers with %s BLAS threads each"%(workers, str(blas_threads) if blas_threads else 'default'))
+    pool = Pool(workers, initializer=_init_forward_worker, initargs=(blas_threads,))
+    try:
+        #imap returns the shards in input order
+        points=[]
+        shards = [ (first, images[first:first+batch_size]) for first in xrange(0, len(images), batch_size) ]
+        for shard_points in pool.imap(_forward_shard, shards):
+            points+=shard_points
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return points
+
+def feed_fwd_batch(
+        prototxt,
+        caffemodel,
+        images,
+        logger,
+        results,
+        batch_size=16,
+        dump_weights=False,
+        weights_format='separate',
+        weights_dtype='float32',
+        scale=1.0,
+        preprocess_workers=0,
+        prefetch=64,
+        preprocess_cache=None,
+        workers=1,
+        blas_threads=None,
+        dump_layers=None,
+        dump_workers=4,
+    ):
+
+    if blas_threads and workers <= 1:
+        set_blas_threads(blas_threads, logger)
+
+    #the network is loaded only once for all images
+    net = load_net(prototxt, caffemodel)
+
+    #dump weights and biases, written in the background while the images are processed
+    writer = BlobWriter(workers=dump_workers)
+    if dump_weights:
+        if weights_format == 'packed':
+            write_packed_weights(net, logger, writer, dtype=weights_dtype, layers=dump_layers)
+        else:
+            write_weights(net, logger, writer, layers=dump_layers)
+
+    #created before forking, the workers would race to create it otherwise
+    if preprocess_cache and not os.path.isdir(preprocess_cache):
+        os.makedirs(preprocess_cache)
+
+    if workers > 1:
+        #worker processes can not start their own preprocessing pool, each worker preprocesses its own shard
+        points = forward_images_parallel(net, images, logger, workers,
+            blas_threads=blas_threads or max(1, cpu_count()//workers),
+            batch_size=batch_size,
+            scale=scale,
+            preprocess_cache=preprocess_cache,
+        )
+    else:
+        points = forward_images(net, images, logger,
+            batch_size=batch_size,
+            scale=scale,
+            preprocess_workers=preprocess_workers,
+            prefetch=prefetch,
+            preprocess_cache=preprocess_cache,
+        )
+
+    #store all results in one file
+    logger.info("Writing results of %d images to %s"%(len(points), results))
+    with open(results, 'wt') as f:
+        json.dump(points, f, sort_keys=True, indent=4)
+
+    writer.close()
+
+    #return index of max for every image
+    return [ p['argmax'] for p in points ]
+
+def benchmark(
+        prototxt,
+        caffemodel,
+        images,
+        logger,
+        batch_sizes=[1],
+        threads=[None],
+        warmup=3,
+        runs=20,
+        scale=1.0,
+    ):
+    #throughput and latency of the reference implementation for every combination of batch size and thread count
+
+    start = time.time()
+    net = load_net(prototxt, caffemodel)
+    net_load_time = time.time()-start
+    logger.info("Loaded network in %f seconds"%(net_load_time))
+
+    transformer = create_transformer(net, scale=scale)
+    data_shape = tuple(net.blobs['data'].data.shape[1:])
+
+    configs=[]
+    for n_threads in threads:
+        if n_threads:
+            set_blas_threads(n_threads, logger)
+
+        for batch_size in batch_sizes:
+            net.blobs['data'].reshape(batch_size, *data_shape)
+            net.reshape()
+
+            phases = dict( (phase, []) for phase in ['load', 'preprocess', 'forward', 'total'] )
+            for run in xrange(warmup+runs):
+                #cycle through the images if there are fewer than needed
+                batch = [ images[(run*batch_size+idx)%len(images)] for idx in xrange(batch_size) ]
+
+                t_start = time.time()
+                decoded = [ caffe.io.load_image(fname) for fname in batch ]
+                t_load = time.time()
+                for idx, image in enumerate(decoded):
+                    net.blobs['data'].data[idx] = transformer.preprocess('data', image)
+                t_preprocess = time.time()
+                net.forward()
+                t_forward = time.time()
+
+                if run >= warmup:
+                    phases['load'].append(t_load-t_start)
+                    phases['preprocess'].append(t_preprocess-t_load)
+                    phases['forward'].append(t_forward-t_preprocess)
+                    phases['total'].append(t_forward-t_start)
+
+            config = {
+                "batch_size": batch_size,
+                "threads": n_threads,
+                "images_per_sec": batch_size*runs/sum(phases['total']),
+                "forward_images_per_sec": batch_size*runs/sum(phases['forward']),
+                "batch_latency": dict( (phase, summarize(times)) for phase, times in phases.items() ),
+            }
+            logger.info("Batch size %d, %s threads: %f images/sec, forward p50 %f seconds"%(batch_size, str(n_threads) if n_threads else 'default', config['images_per_sec'], config['batch_latency']['forward']['p50']))
+            configs.append(config)
+
+    return {
+        "network": os.path.splitext(os.path.basename(prototxt))[0],
+        "net_load_time": net_load_time,
+        "warmup": warmup,
+        "runs": runs,
+        "configs": configs,
+    }
+
+def feed_fwd_server(
+        socket_path,
+        prototxt,
+        images,
+        logger,
+        results=None,
+    ):
+    #imported here, the server module itself depends on this module
+    from InferenceServer import InferenceClient, network_name
+
+    points=[]
+    with InferenceClient(socket_path) as client:
+        for fname in images:
+            logger.debug("Requesting inference of %s"%(fname))
+            response = client.infer(fname, network=network_name(prototxt), probabilities=results is not None)
+            logger.info("Index of largest output of %s is \"%d\", with value \"%s\""%(fname, response['argmax'], str(response['value'])))
+            response['image']=fname
+            points.append(response)
+
+    if results:
+        logger.info("Writing results of %d images to %s"%(len(points), results))
+        with open(results, 'wt') as f:
+            json.dump(points, f, sort_keys=True, indent=4)
+
+    return [ p['argmax'] for p in points ]
+
 def get_args():
     parser = argparse.ArgumentParser()
 
@@ -127,25 +603,133 @@ def get_args():
     parser.add_argument('--caffe-prototxt', dest='caffeprototxt', required=True,
         help="Caffe prototxt file",
     )
-    parser.add_argument('--caffe-model', dest='caffemodel', required=True,
-        help="Caffe model file",
+    parser.add_argument('--caffe-model', dest='caffemodel', required=False, default=None,
+        help="Caffe model file. Optional with --server, which uses the model the server was started with",
     )
-    parser.add_argument('--image', dest='image', required=True,
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--image', dest='image', default=None,
         help="Input image",
     )
+    inputs.add_argument('--images', dest='images', default=None,
+        help="Directory with input images, or file with one image path per line. All images are processed with a single network instance",
+    )
+    parser.add_argument('--batch-size', dest='batch_size', required=False, default=16, type=int,
+        help="Number of images per feedforward in batch mode (--images)",
+    )
+    parser.add_argument('--results', dest='results', required=False, default='results.json',
+        help="Output file with the argmax and probabilities of each image in batch mode (--images)",
+    )
+    parser.add_argument('--workers', dest='workers', required=False, default=1, type=int,
+        help="Number of processes that each forward a share of the images in batch mode. The network is loaded once and its weights are shared by all processes",
+    )
+    parser.add_argument('--blas-threads', dest='blas_threads', required=False, default=None, type=int,
+        help="Number of BLAS threads per process. Defaults to the number of cores divided by the number of workers",
+    )
+    parser.add_argument('--preprocess-workers', dest='preprocess_workers', required=False, default=0, type=int,
+        help="Number of processes that decode and transform images ahead of the feedforward in batch mode. 0 preprocesses in the main process",
+    )
+    parser.add_argument('--prefetch', dest='prefetch', required=False, default=64, type=int,
+        help="Maximum number of preprocessed images waiting for the feedforward in batch mode",
+    )
+    parser.add_argument('--preprocess-cache', dest='preprocess_cache', required=False, default=None,
+        help="Directory to cache preprocessed images as .npy files, keyed by image content and transformation settings",
+    )
     parser.add_argument('--scale', dest='scale', required=False, default=1.0,type=float,
         help="Input scaling (Mobilenets require scale=0.017)",
     )
     parser.add_argument('--dump-weights', dest='dump_weights', required=False, action='store_true', default=False,
         help="Dump weights and bias values of all convolutional layers"
     )
+    parser.add_argument('--weights-format', dest='weights_format', required=False, choices=['separate', 'packed'], default='separate',
+        help="Format of dumped weights. 'separate' writes <layer>_weights.bin and <layer>_bias.bin per layer, 'packed' writes one aligned weights.pack with an index header that can be memory-mapped",
+    )
+    parser.add_argument('--weights-dtype', dest='weights_dtype', required=False, choices=PACK_DTYPES, default='float32',
+        help="Data type of packed weights. int8 weights are quantized per tensor, the scale is stored in the index",
+    )
     parser.add_argument('--dump-buffers', dest='dump_buffers', required=False, action='store_true', default=False,
         help="Dump all intermediate buffers for debugging"
     )
+    parser.add_argument('--dump-format', dest='dump_format', required=False, choices=['binary', 'text'], default='binary',
+        help="Format of dumped buffers. 'binary' writes buffers.bin with a buffers.json manifest that can be memory-mapped, 'text' writes one <layer>_buf.txt per layer",
+    )
+    parser.add_argument('--profile', dest='profile', required=False, default=None,
+        help="Profile the network layer by layer and write time, blob sizes and memory usage of every layer to this json file",
+    )
+    parser.add_argument('--profile-runs', dest='profile_runs', required=False, default=5, type=int,
+        help="Number of profiling runs, the median time of each layer is reported",
+    )
+    parser.add_argument('--benchmark', dest='benchmark', required=False, default=None,
+        help="Benchmark the network and write throughput and latency of the load, preprocess and forward phases to this json file",
+    )
+    parser.add_argument('--benchmark-batch-sizes', dest='benchmark_batch_sizes', required=False, default=[1], type=int, nargs='+',
+        help="Batch sizes to benchmark",
+    )
+    parser.add_argument('--benchmark-threads', dest='benchmark_threads', required=False, default=[None], type=int, nargs='+',
+        help="BLAS thread counts to benchmark. Defaults to the BLAS default",
+    )
+    parser.add_argument('--benchmark-warmup', dest='benchmark_warmup', required=False, default=3, type=int,
+        help="Number of untimed forward passes before each benchmark",
+    )
+    parser.add_argument('--benchmark-runs', dest='benchmark_runs', required=False, default=20, type=int,
+        help="Number of timed forward passes of each benchmark",
+    )
+    parser.add_argument('--tile', dest='tile', required=False, default=None, type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+        help="Forward the image in tiles of this many input pixels plus the halo required by the network, and stitch the outputs. Requires a fully convolutional network with a 4D (N,C,H,W) input",
+    )
+    parser.add_argument('--tile-workers', dest='tile_workers', required=False, default=1, type=int,
+        help="Number of processes that forward tiles in parallel",
+    )
+    parser.add_argument('--cache', dest='cache', required=False, default=None,
+        help="Directory of a cache with reference outputs and buffer dumps, keyed by the content of prototxt, caffemodel, image and transformation settings",
+    )
+    parser.add_argument('--cache-size', dest='cache_size', required=False, default=None, type=float,
+        help="Maximum size of the cache in MB. Least recently used entries are evicted first",
+    )
+    parser.add_argument('--dump-layers', dest='dump_layers', required=False, default=None, nargs='+', metavar='REGEX',
+        help="Only dump weights and buffers of layers whose name matches one of these regular expressions, e.g. 'conv.*'",
+    )
+    parser.add_argument('--dump-workers', dest='dump_workers', required=False, default=4, type=int,
+        help="Number of background threads that write dumps",
+    )
+    parser.add_argument('--dump-compress', dest='dump_compress', required=False, action='store_true', default=False,
+        help="Compress text buffer dumps with gzip",
+    )
+    parser.add_argument('--server', dest='server', required=False, default=None,
+        help="Unix socket of a running InferenceServer.py. Images are sent to the server instead of loading the network in this process",
+    )
 
     # Parse arguments
     args = parser.parse_args()
 
+    if args.weights_dtype != 'float32' and args.weights_format != 'packed':
+        parser.error("--weights-dtype requires --weights-format=packed")
+
+    if args.dump_compress and args.dump_format != 'text':
+        parser.error("--dump-compress requires --dump-format=text, binary dumps are kept uncompressed so they can be memory-mapped")
+
+    if args.tile and (args.dump_buffers or args.profile):
+        parser.error("--tile can not be combined with --dump-buffers or --profile, the intermediate buffers only hold the last tile")
+
+    #every mode rejects the options it does not use instead of silently ignoring them
+    if args.benchmark:
+        mode, options = '--benchmark', ['benchmark', 'caffemodel', 'scale', 'benchmark_batch_sizes', 'benchmark_threads', 'benchmark_warmup', 'benchmark_runs']
+    elif args.server:
+        mode, options = '--server', ['server', 'caffemodel', 'results']
+    elif args.images:
+        mode, options = '--images', ['caffemodel', 'batch_size', 'results', 'dump_weights', 'weights_format', 'weights_dtype', 'scale', 'preprocess_workers', 'prefetch', 'preprocess_cache',
+            'workers', 'blas_threads', 'dump_layers', 'dump_workers']
+    else:
+        mode, options = '--image', ['caffemodel', 'dump_buffers', 'dump_weights', 'weights_format', 'weights_dtype', 'dump_format', 'scale', 'profile', 'profile_runs', 'tile', 'tile_workers',
+            'dump_layers', 'dump_workers', 'dump_compress', 'cache', 'cache_size']
+    option = lambda dest: {'caffemodel': '--caffe-model'}.get(dest, '--'+dest.replace('_', '-'))
+    ignored = [ option(dest) for dest, value in sorted(vars(args).items())
+        if dest not in ['log_level', 'caffeprototxt', 'image', 'images'] and dest not in options and value != parser.get_default(dest) ]
+    if ignored:
+        parser.error("%s can not be used with %s"%(', '.join(ignored), mode))
+
+    if not args.server and not args.caffemodel:
+        parser.error("--caffe-model is required unless --server is given")
+
     # Init logger
     logging.basicConfig(level=args.log_level)
     args.logger = logging.getLogger()
@@ -161,12 +745,66 @@ if __name__ == '__main__':
 
     args = get_args()
 
-    argmax=feed_fwd(
-        args.caffeprototxt,
-        args.caffemodel,
-        args.image,
-        args.logger,
-        dump_buffers=args.dump_buffers,
-        dump_weights=args.dump_weights,
-        scale=args.scale
-    )
+    if args.benchmark:
+        result=benchmark(
+            args.caffeprototxt,
+            args.caffemodel,
+            list_images(args.images) if args.images else [args.image],
+            args.logger,
+            batch_sizes=args.benchmark_batch_sizes,
+            threads=args.benchmark_threads,
+            warmup=args.benchmark_warmup,
+            runs=args.benchmark_runs,
+            scale=args.scale,
+        )
+        with open(args.benchmark, 'wt') as f:
+            json.dump(result, f, sort_keys=True, indent=4)
+    elif args.server:
+        argmax=feed_fwd_server(
+            args.server,
+            args.caffeprototxt,
+            list_images(args.images) if args.images else [args.image],
+            args.logger,
+            results=args.results if args.images else None,
+        )
+    elif args.images:
+        argmax=feed_fwd_batch(
+            args.caffeprototxt,
+            args.caffemodel,
+            list_images(args.images),
+            args.logger,
+            args.results,
+            batch_size=args.batch_size,
+            dump_weights=args.dump_weights,
+            weights_format=args.weights_format,
+            weights_dtype=args.weights_dtype,
+            scale=args.scale,
+            preprocess_workers=args.preprocess_workers,
+            prefetch=args.prefetch,
+            preprocess_cache=args.preprocess_cache,
+            workers=args.workers,
+            blas_threads=args.blas_threads,
+            dump_layers=args.dump_layers,
+            dump_workers=args.dump_workers,
+        )
+    else:
+        argmax=feed_fwd(
+            args.caffeprototxt,
+            args.caffemodel,
+            args.image,
+            args.logger,
+            dump_buffers=args.dump_buffers,
+            dump_weights=args.dump_weights,
+            weights_format=args.weights_format,
+            weights_dtype=args.weights_dtype,
+            dump_format=args.dump_format,
+            scale=args.scale,
+            profile=args.profile,
+            profile_runs=args.profile_runs,
+            tile=args.tile,
+            tile_workers=args.tile_workers,
+            dump_layers=args.dump_layers,
+            dump_workers=args.dump_workers,
+            dump_compress=args.dump_compress,
+            cache=GoldenCache(args.cache, max_bytes=int(args.cache_size*1024*1024) if args.cache_size else None) if args.cache else None,
+        )
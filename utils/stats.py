@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+
+def median(values):
+    values = sorted(values)
+    mid = len(values)//2
+    return values[mid] if len(values)%2 else 0.5*(values[mid-1]+values[mid])
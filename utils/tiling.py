@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+from multiprocessing import Pool
+import numpy as np
+import tempfile
+import math
+
+import caffe
+from caffe.proto import caffe_pb2
+from google.protobuf import text_format
+
+#layers that do not mix values of different spatial positions
+POINTWISE_LAYERS=[
+    'ReLU', 'PReLU', 'ELU', 'Sigmoid', 'TanH', 'AbsVal', 'Power', 'Exp', 'Log', 'BNLL', 'Threshold',
+    'BatchNorm', 'Scale', 'Bias', 'Dropout', 'Eltwise', 'Split', 'Softmax', 'MVN',
+]
+
+def _pair(repeated, h, w, has_hw, default):
+    #caffe allows either one value, one value per axis, or explicit _h/_w fields
+    if has_hw:
+        return (h, w)
+    if len(repeated)==0:
+        return (default, default)
+    if len(repeated)==1:
+        return (repeated[0], repeated[0])
+    return (repeated[0], repeated[1])
+
+def _window(layer):
+    #returns (kernel, stride, pad, dilation) per spatial axis of a layer, or None for pointwise layers
+    if layer.type == 'Convolution':
+        p = layer.convolution_param
+        kernel = _pair(p.kernel_size, p.kernel_h, p.kernel_w, p.HasField('kernel_h'), 1)
+        stride = _pair(p.stride, p.stride_h, p.stride_w, p.HasField('stride_h'), 1)
+        pad = _pair(p.pad, p.pad_h, p.pad_w, p.HasField('pad_h'), 0)
+        dilation = _pair(p.dilation, 0, 0, False, 1)
+        return kernel, stride, pad, dilation
+
+    if layer.type == 'Pooling':
+        p = layer.pooling_param
+        if p.global_pooling:
+            raise ValueError("layer %s uses global pooling, which can not be tiled"%(layer.name))
+        kernel = (p.kernel_h, p.kernel_w) if p.HasField('kernel_h') else (p.kernel_size, p.kernel_size)
+        stride = (p.stride_h, p.stride_w) if p.HasField('stride_h') else (p.stride, p.stride)
+        pad = (p.pad_h, p.pad_w) if p.HasField('pad_h') else (p.pad, p.pad)
+        return kernel, stride, pad, (1, 1)
+
+    if layer.type == 'LRN' and layer.lrn_param.norm_region == caffe_pb2.LRNParameter.WITHIN_CHANNEL:
+        size = layer.lrn_param.local_size
+        return (size, size), (1, 1), ((size-1)//2, (size-1)//2), (1, 1)
+
+    #slicing or concatenating channels is pointwise in the spatial dimensions
+    if layer.type in ['Slice', 'Concat']:
+        axis = layer.slice_param.axis if layer.type == 'Slice' else layer.concat_param.axis
+        if axis != 1:
+            raise ValueError("layer %s slices or concatenates a spatial axis, which can not be tiled"%(layer.name))
+        return None
+
+    if layer.type in POINTWISE_LAYERS:
+        return None
+
+    raise ValueError("layer %s of type %s can not be tiled"%(layer.name, layer.type))
+
+def load_net_param(prototxt):
+    net_param = caffe_pb2.NetParameter()
+    with open(prototxt, 'rt') as f:
+        text_format.Merge(f.read(), net_param)
+    return net_param
+
+def input_shape(net_param):
+    #shape of the input of the network, declared either by an Input layer or by the deprecated input fields
+    inputs = list(net_param.input) + [ top for layer in net_param.layer if layer.type == 'Input' for top in layer.top ]
+    if len(inputs) != 1:
+        raise ValueError("tiling requires a network with a single input, found %d"%(len(inputs)))
+    if net_param.input_shape:
+        return tuple(net_param.input_shape[0].dim)
+    if net_param.input_dim:
+        return tuple(net_param.input_dim)
+    for layer in net_param.layer:
+        if layer.type == 'Input':
+            return tuple(layer.input_param.shape[0].dim)
+
+def set_input_shape(net_param, shape):
+    if net_param.input:
+        del net_param.input_dim[:]
+        del net_param.input_shape[:]
+        net_param.input_shape.add().dim.extend(shape)
+    for layer in net_param.layer:
+        if layer.type == 'Input':
+            del layer.input_param.shape[:]
+            layer.input_param.shape.add().dim.extend(shape)
+
+def output_names(net_param):
+    #blobs that no layer consumes, in the same order as net.outputs of caffe
+    outputs = list(net_param.input)
+    for layer in net_param.layer:
+        for bottom in layer.bottom:
+            if bottom in outputs:
+                outputs.remove(bottom)
+        for top in layer.top:
+            if top not in outputs:
+                outputs.append(top)
+    return outputs
+
+def receptive_fields(net_param):
+    #for every blob returns per spatial axis a tuple (jump, size, start):
+    #output position g of the blob depends on input positions [g*jump+start, g*jump+start+size)
+    #start is negative when padding is involved
+    fields = dict( (name, ((1, 1, 0), (1, 1, 0))) for name in net_param.input )
+    for layer in net_param.layer:
+        if layer.type == 'Input':
+            for top in layer.top:
+                fields[top] = ((1, 1, 0), (1, 1, 0))
+            continue
+
+        bottoms = [ fields[bottom] for bottom in layer.bottom ]
+        window = _window(layer)
+
+        field=[]
+        for axis in range(2):
+            #layers with multiple inputs depend on the union of the fields of their inputs
+            jumps = set( b[axis][0] for b in bottoms )
+            if len(jumps) != 1:
+                raise ValueError("inputs of layer %s have different strides"%(layer.name))
+            jump = jumps.pop()
+            start = min( b[axis][2] for b in bottoms )
+            size = max( b[axis][2]+b[axis][1] for b in bottoms ) - start
+
+            if window:
+                kernel, stride, pad, dilation = [ w[axis] for w in window ]
+                size += (dilation*(kernel-1))*jump
+                start -= pad*jump
+                jump *= stride
+
+            field.append((jump, size, start))
+
+        for top in layer.top:
+            fields[top] = tuple(field)
+
+    return fields
+
+def spatial_sizes(net_param, in_size):
+    #height and width of every blob for an input of in_size, following the shape rules of caffe
+    sizes = dict( (name, tuple(in_size)) for name in net_param.input )
+    for layer in net_param.layer:
+        if layer.type == 'Input':
+            for top in layer.top:
+                sizes[top] = tuple(in_size)
+            continue
+
+        size = sizes[layer.bottom[0]]
+        window = _window(layer)
+        if window:
+            out=[]
+            for axis in range(2):
+                kernel, stride, pad, dilation = [ w[axis] for w in window ]
+                if layer.type == 'Pooling':
+                    #pooling rounds up, but the last window has to start inside the image or its padding
+                    n = int(math.ceil(float(size[axis]+2*pad-kernel)/stride))+1
+                    if pad and (n-1)*stride >= size[axis]+pad:
+                        n -= 1
+                else:
+                    n = (size[axis]+2*pad-dilation*(kernel-1)-1)//stride+1
+                out.append(n)
+            size = tuple(out)
+
+        for top in layer.top:
+            sizes[top] = size
+
+    return sizes
+
+def plan_axis(field, in_size, out_size, tile):
+    #split one axis in tiles with a core of 'tile' input positions
+    #returns (input start, input end, output start, output end, offset of the output in the tile)
+    jump, size, start = field
+    tile_out = max(1, tile//jump)
+
+    plan=[]
+    for a in range(0, out_size, tile_out):
+        b = min(a+tile_out, out_size)
+
+        #the tile has to start on a multiple of the stride to keep the output grid aligned
+        #at the image border the network pads the tile exactly like it pads the full image
+        s = max(0, (a*jump+start)//jump*jump)
+        e = min(in_size, (b-1)*jump+start+size)
+        plan.append((s, e, a, b, a-s//jump))
+
+    return plan
+
+def plan_tiles(fields, outputs, in_size, sizes, tile):
+    #all outputs are computed from the same tiles, so they must share the same grid
+    if len(set( tuple(f[0] for f in fields[name]) for name in outputs )) != 1:
+        raise ValueError("outputs of the network have different strides and can not be tiled together")
+    if len(set( sizes[name] for name in outputs )) != 1:
+        raise ValueError("outputs of the network have different sizes and can not be tiled together")
+
+    #the halo has to cover the union of the receptive fields of all outputs
+    union=[]
+    for axis in range(2):
+        jump = fields[outputs[0]][axis][0]
+        start = min( fields[name][axis][2] for name in outputs )
+        size = max( fields[name][axis][2]+fields[name][axis][1] for name in outputs ) - start
+        union.append((jump, size, start))
+
+    out_size = sizes[outputs[0]]
+    rows = plan_axis(union[0], in_size[0], out_size[0], tile[0])
+    cols = plan_axis(union[1], in_size[1], out_size[1], tile[1])
+    return [ (r, c) for r in rows for c in cols ]
+
+def forward_tile(net, data, outputs, tile):
+    (ys, ye, oya, oyb, ty), (xs, xe, oxa, oxb, tx) = tile
+
+    net.blobs['data'].reshape(*(data.shape[:-2]+(ye-ys, xe-xs)))
+    net.reshape()
+    net.blobs['data'].data[...] = data[..., ys:ye, xs:xe]
+    result = net.forward()
+
+    crops={}
+    for name in outputs:
+        out = result[name]
+        if out.shape[-2] < ty+oyb-oya or out.shape[-1] < tx+oxb-oxa:
+            raise ValueError("tile %s of output %s is smaller than expected, the network can not be tiled"%(str(tile), name))
+        crops[name] = out[..., ty:ty+oyb-oya, tx:tx+oxb-oxa].copy()
+    return crops
+
+#state shared with forked workers, see inference.forward_images_parallel
+_shared = {}
+
+def _forward_tile(tile):
+    return tile, forward_tile(_shared['net'], _shared['data'], _shared['outputs'], tile)
+
+def load_tiled_net(prototxt, caffemodel, tile, logger):
+    #load the network at the size of the largest tile plus its halo instead of the size of the full input
+    #returns the network and the plan to forward the full input through it
+    net_param = load_net_param(prototxt)
+    in_shape = input_shape(net_param)
+
+    #caffe takes axis 1 as channels, only a 4D input has two spatial axes after it
+    #a 1x720x1280 input is convolved along its last axis only, tiling its second axis would split channels
+    if len(in_shape) != 4:
+        raise ValueError("tiling requires a 4D (N,C,H,W) input, the input of %s has shape %s"%(prototxt, 'x'.join(map(str, in_shape))))
+    outputs = output_names(net_param)
+    fields = receptive_fields(net_param)
+    sizes = spatial_sizes(net_param, in_shape[-2:])
+
+    tiles = plan_tiles(fields, outputs, in_shape[-2:], sizes, tile)
+    for name in outputs:
+        (jy, sy, oy), (jx, sx, ox) = fields[name]
+        logger.info("Output %s has a receptive field of %dx%d with stride %dx%d"%(name, sy, sx, jy, jx))
+
+    #tiles only get smaller than the largest one, so forward_tile never grows the blobs
+    #the network is loaded for a single image, tiled_forward is only used for one image at a time
+    tile_shape = (max( ye-ys for (ys, ye, _, _, _), _ in tiles ), max( xe-xs for _, (xs, xe, _, _, _) in tiles ))
+    logger.info("Loading network for tiles of %dx%d input pixels including the halo"%tile_shape)
+
+    #pycaffe only loads networks from a file
+    tile_param = caffe_pb2.NetParameter()
+    tile_param.CopyFrom(net_param)
+    set_input_shape(tile_param, (1,)+in_shape[1:-2]+tile_shape)
+    with tempfile.NamedTemporaryFile('wt', suffix='.prototxt') as f:
+        f.write(text_format.MessageToString(tile_param))
+        f.flush()
+
+        # Use CPU for verification
+        caffe.set_mode_cpu()
+        net = caffe.Net(f.name, caffemodel, caffe.TEST)
+
+    plan = {
+        "input_shape": in_shape,
+        "tile": tuple(tile),
+        "tiles": tiles,
+        "outputs": outputs,
+        "sizes": dict( (name, sizes[name]) for name in outputs ),
+    }
+    return net, plan
+
+def tiled_forward(net, plan, data, logger, workers=1):
+    #forward data of shape (N,C,H,W) tile by tile and stitch the outputs
+    #peak memory of the intermediate blobs is bounded by the tile size and the halo
+    outputs = plan['outputs']
+    tiles = plan['tiles']
+    logger.info("Forwarding %d tiles of %dx%d"%(len(tiles), plan['tile'][0], plan['tile'][1]))
+
+    #only the spatial size of the outputs depends on the input size
+    out_shapes = dict( (name, (data.shape[0],)+tuple(net.blobs[name].shape[1:-2])+plan['sizes'][name]) for name in outputs )
+    stitched = dict( (name, np.zeros(out_shapes[name], dtype=np.float32)) for name in outputs )
+    def stitch(tile, crops):
+        (ys, ye, oya, oyb, ty), (xs, xe, oxa, oxb, tx) = tile
+        for name in outputs:
+            stitched[name][..., oya:oyb, oxa:oxb] = crops[name]
+
+    if workers > 1:
+        _shared['net'] = net
+        _shared['data'] = data
+        _shared['outputs'] = outputs
+        pool = Pool(workers)
+        try:
+            for tile_spec, crops in pool.imap_unordered(_forward_tile, tiles):
+                stitch(tile_spec, crops)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for idx, tile_spec in enumerate(tiles):
+            logger.debug("Forwarding tile %d of %d"%(idx+1, len(tiles)))
+            stitch(tile_spec, forward_tile(net, data, outputs, tile_spec))
+
+    return stitched